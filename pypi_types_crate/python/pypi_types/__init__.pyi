@@ -1,10 +1,26 @@
 from typing import Any
 
-from pypi_types.pep440_rs import Version
+from pypi_types.pep440_rs import Version, VersionSpecifier
+from pypi_types.pep508_rs import Requirement
 from pypi_types.pypi_releases import File
 
 def filename_to_version(*args, **kwargs) -> Any: ...
 def parse_releases_data(*args, **kwargs) -> Any: ...
+def parse_releases_bytes(
+    project: str, data: bytes
+) -> tuple[dict[Version, list[File]], list[str], list[str]]: ...
 def collect_extras(*args, **kwargs) -> Any: ...
+def parse_requirements(requirements: list[str]) -> list[Requirement]: ...
+def pick_version(
+    versions: list[Version],
+    specifiers: list[VersionSpecifier],
+    maximum: bool,
+    allowed_prereleases: set[tuple[int, ...]],
+) -> Version | None: ...
+def count_versions(
+    versions: list[Version],
+    specifiers: list[VersionSpecifier],
+    allowed_prereleases: set[tuple[int, ...]],
+) -> int: ...
 def read_parsed_release_data(data: bytes) -> dict[Version, list[File]]: ...
 def write_parsed_release_data(data: dict[Version, list[File]]) -> str: ...
@@ -87,4 +87,5 @@ class Vulnerability:
     withdrawn: Any | None
 
 def parse(text: bytes) -> Welcome: ...
+def parse_requires_dist(text: bytes) -> list[str] | None: ...
 def parse_metadata(text: str) -> Metadata: ...
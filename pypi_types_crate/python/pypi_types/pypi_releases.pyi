@@ -14,7 +14,10 @@ class File:
     upload_time: str | None
     url: str
     yanked: bool | str
+    data_dist_info_metadata: bool | dict[str, str] | None
+    core_metadata: bool | dict[str, str] | None
 
+    def has_metadata_file(self) -> bool: ...
     @staticmethod
     def vec_to_json(data: list[File]) -> str: ...
     @staticmethod
@@ -1,5 +1,5 @@
 use once_cell::sync::Lazy;
-use pep440_rs::Version;
+use pep440_rs::{Version, VersionSpecifier};
 use pep508_rs::{MarkerOperator, MarkerTree, MarkerValue, Requirement};
 use pyo3::exceptions::{PyFileNotFoundError, PyRuntimeError, PyValueError};
 use pyo3::pyfunction;
@@ -100,19 +100,49 @@ pub fn parse_releases_data(
     Vec<String>,
     Vec<String>,
 )> {
-    let mut releases: HashMap<Version, Vec<pypi_releases::File>> = HashMap::new();
-    let mut ignored_filenames: Vec<String> = Vec::new();
-    let mut invalid_versions: Vec<String> = Vec::new();
-
     let reader = BufReader::new(
         File::open(filename).map_err(|err| PyFileNotFoundError::new_err(err.to_string()))?,
     );
     let data: pypi_releases::PypiReleases =
         serde_json::from_reader(reader).map_err(|err| PyRuntimeError::new_err(err.to_string()))?;
+    group_releases(project, data)
+}
+
+/// Like `parse_releases_data`, but for a response body. This keeps the filename to version
+/// loop out of python, where it would cross into rust twice for each file
+#[pyfunction]
+#[allow(clippy::type_complexity)] // Newtype would be worse for pyo3
+pub fn parse_releases_bytes(
+    project: &str,
+    data: &[u8],
+) -> PyResult<(
+    HashMap<Version, Vec<pypi_releases::File>>,
+    Vec<String>,
+    Vec<String>,
+)> {
+    let data: pypi_releases::PypiReleases =
+        serde_json::from_slice(data).map_err(|err| PyRuntimeError::new_err(err.to_string()))?;
+    group_releases(project, data)
+}
+
+#[allow(clippy::type_complexity)]
+fn group_releases(
+    project: &str,
+    data: pypi_releases::PypiReleases,
+) -> PyResult<(
+    HashMap<Version, Vec<pypi_releases::File>>,
+    Vec<String>,
+    Vec<String>,
+)> {
+    let mut releases: HashMap<Version, Vec<pypi_releases::File>> = HashMap::new();
+    let mut ignored_filenames: Vec<String> = Vec::new();
+    let mut invalid_versions: Vec<String> = Vec::new();
+
     if !["1.0", "1.1"].contains(&data.meta.api_version.as_str()) {
-        return Err(PyRuntimeError::new_err(
-            "Unsupported api version {data.meta.api_version}",
-        ));
+        return Err(PyRuntimeError::new_err(format!(
+            "Unsupported api version {}",
+            data.meta.api_version
+        )));
     }
 
     for file in data.files {
@@ -133,6 +163,62 @@ pub fn parse_releases_data(
     Ok((releases, ignored_filenames, invalid_versions))
 }
 
+/// Parses a list of requirements with a single call from python.
+///
+/// This is the fast path for the common case where all requirements are valid, it errors if any
+/// of them is invalid. The caller is expected to fall back to parsing them one by one then.
+#[pyfunction]
+pub fn parse_requirements(requirements: Vec<&str>) -> PyResult<Vec<Requirement>> {
+    requirements
+        .into_iter()
+        .map(|requirement| {
+            Requirement::from_str(requirement).map_err(|err| PyValueError::new_err(err.to_string()))
+        })
+        .collect()
+}
+
+/// Pick the highest (or with `maximum` false the lowest) of the sorted `versions` that matches
+/// all `specifiers`. A prerelease is only considered if its release is in
+/// `allowed_prereleases`. This is the inner loop of the resolver, so we keep it out of python.
+#[pyfunction]
+pub fn pick_version(
+    versions: Vec<Version>,
+    specifiers: Vec<VersionSpecifier>,
+    maximum: bool,
+    allowed_prereleases: HashSet<Vec<usize>>,
+) -> Option<Version> {
+    let is_compatible = |version: &&Version| {
+        (!version.any_prerelease() || allowed_prereleases.contains(&version.release))
+            && specifiers
+                .iter()
+                .all(|specifier| specifier.contains(version))
+    };
+    if maximum {
+        versions.iter().rev().find(is_compatible).cloned()
+    } else {
+        versions.iter().find(is_compatible).cloned()
+    }
+}
+
+/// The number of `versions` that `pick_version` could pick with the same arguments. The
+/// resolver uses it to order the queue, so it runs for every enqueued package.
+#[pyfunction]
+pub fn count_versions(
+    versions: Vec<Version>,
+    specifiers: Vec<VersionSpecifier>,
+    allowed_prereleases: HashSet<Vec<usize>>,
+) -> usize {
+    versions
+        .iter()
+        .filter(|version| {
+            (!version.any_prerelease() || allowed_prereleases.contains(&version.release))
+                && specifiers
+                    .iter()
+                    .all(|specifier| specifier.contains(version))
+        })
+        .count()
+}
+
 /// Depth-first recursive iteration over a MarkerTree to collect all marker mappings.
 ///
 /// Ignores everything that doesn't look like `extras = ...`, `extras != ...`, `... = extras` or
@@ -27,7 +27,11 @@ pub fn pypi_types(py: Python, module: &PyModule) -> PyResult<()> {
 
     module.add_function(wrap_pyfunction!(helper::filename_to_version, py)?)?;
     module.add_function(wrap_pyfunction!(helper::parse_releases_data, py)?)?;
+    module.add_function(wrap_pyfunction!(helper::parse_releases_bytes, py)?)?;
     module.add_function(wrap_pyfunction!(helper::collect_extras, py)?)?;
+    module.add_function(wrap_pyfunction!(helper::parse_requirements, py)?)?;
+    module.add_function(wrap_pyfunction!(helper::pick_version, py)?)?;
+    module.add_function(wrap_pyfunction!(helper::count_versions, py)?)?;
     module.add_function(wrap_pyfunction!(helper::write_parsed_release_data, py)?)?;
     module.add_function(wrap_pyfunction!(helper::read_parsed_release_data, py)?)?;
 
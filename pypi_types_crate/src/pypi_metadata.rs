@@ -183,6 +183,24 @@ pub fn parse(data: &[u8]) -> anyhow::Result<Welcome> {
     Ok(serde_json::from_slice(data)?)
 }
 
+/// Only the part of the json the resolver needs, serde skips over the rest (description,
+/// urls, vulnerabilities, ...) without allocating it
+#[derive(Deserialize)]
+struct RequiresDistOnly {
+    info: RequiresDistInfo,
+}
+
+#[derive(Deserialize)]
+struct RequiresDistInfo {
+    requires_dist: Option<Vec<String>>,
+}
+
+#[pyfunction]
+pub fn parse_requires_dist(data: &[u8]) -> anyhow::Result<Option<Vec<String>>> {
+    let parsed: RequiresDistOnly = serde_json::from_slice(data)?;
+    Ok(parsed.info.requires_dist)
+}
+
 #[pyfunction]
 pub fn parse_metadata(text: &str) -> anyhow::Result<Metadata> {
     Ok(serde_json::from_str(text)?)
@@ -191,6 +209,7 @@ pub fn parse_metadata(text: &str) -> anyhow::Result<Metadata> {
 #[pymodule]
 pub fn pypi_metadata(_py: Python, module: &PyModule) -> PyResult<()> {
     module.add_function(wrap_pyfunction!(parse, module)?)?;
+    module.add_function(wrap_pyfunction!(parse_requires_dist, module)?)?;
     module.add_function(wrap_pyfunction!(parse_metadata, module)?)?;
     module.add_class::<Welcome>()?;
     module.add_class::<Metadata>()?;
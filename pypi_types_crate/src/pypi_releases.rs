@@ -8,6 +8,7 @@ use pyo3::{
     pyclass, pyfunction, pymethods, pymodule, wrap_pyfunction, IntoPy, PyObject, PyResult, Python,
 };
 use serde::{Deserialize, Serialize};
+use std::collections::HashMap;
 
 #[derive(Debug, Clone, Serialize, Deserialize, Eq, PartialEq)]
 #[pyclass(dict, get_all)]
@@ -30,6 +31,15 @@ pub struct File {
     pub url: String,
     // TODO: This either a bool (false) or a string with the reason
     pub yanked: Yanked,
+    /// PEP 658: If present and not false, the core metadata of this file is available
+    /// separately at `{url}.metadata`
+    #[serde(default, skip_serializing_if = "Option::is_none")]
+    pub data_dist_info_metadata: Option<DistInfoMetadata>,
+    /// PEP 714 renamed `data-dist-info-metadata` to `core-metadata`. Indexes may send
+    /// either or both, so this is a separate field instead of a serde alias, which
+    /// would reject a duplicate field
+    #[serde(default, skip_serializing_if = "Option::is_none")]
+    pub core_metadata: Option<DistInfoMetadata>,
 }
 
 #[pymethods]
@@ -50,6 +60,14 @@ impl File {
         self.filename.clone()
     }
 
+    /// Whether the core metadata is available at `{url}.metadata` (PEP 658 and PEP 714)
+    fn has_metadata_file(&self) -> bool {
+        [&self.core_metadata, &self.data_dist_info_metadata]
+            .into_iter()
+            .flatten()
+            .any(|metadata| !matches!(metadata, DistInfoMetadata::Bool(false)))
+    }
+
     fn __repr__(&self) -> String {
         self.filename.clone()
     }
@@ -90,6 +108,23 @@ impl Yanked {
     }
 }
 
+/// Either a bool or the hashes of the `.metadata` file
+#[derive(Debug, Clone, Serialize, Deserialize, Eq, PartialEq)]
+#[serde(untagged)]
+pub enum DistInfoMetadata {
+    Bool(bool),
+    Hashes(HashMap<String, String>),
+}
+
+impl IntoPy<PyObject> for DistInfoMetadata {
+    fn into_py(self, py: Python<'_>) -> PyObject {
+        match self {
+            DistInfoMetadata::Bool(bool) => bool.into_py(py),
+            DistInfoMetadata::Hashes(hashes) => hashes.into_py(py),
+        }
+    }
+}
+
 #[derive(Debug, Clone, Serialize, Deserialize, Eq, PartialEq)]
 #[pyclass(dict, get_all)]
 pub struct Hashes {
@@ -1,25 +1,49 @@
 import logging
+import os
 import random
 import re
 import string
+from functools import cache
 from pathlib import Path
 from typing import NewType
 
 MINIMUM_SUPPORTED_PYTHON_MINOR = 7
+# Limit for parallel requests to pypi, so we don't exhaust the connection pool
+MAX_CONCURRENT_REQUESTS = 16
 
 logger = logging.getLogger(__name__)
 user_agent = "monotrail-resolve-prototype/0.0.1-dev1+cat <konstin@mailbox.org>"
 base_dir = Path(__file__).parent.parent
 default_cache_dir = base_dir.joinpath("cache")
 normalizer = re.compile(r"[-_.]+")
+# Where sdists are extracted and built, the system temp dir by default. Set it to a
+# tmpfs such as /dev/shm so the many small files don't go to disk, but note that large
+# sdists can fill the memory-backed /dev/shm
+default_tmp_root: Path | None = (
+    Path(os.environ["RESOLVE_TMPDIR"]) if "RESOLVE_TMPDIR" in os.environ else None
+)
 
 NormalizedName = NewType("NormalizedName", str)
 
 
+# We normalize the same few hundred names over and over in the resolver loops. The
+# requirements are rust objects, so we can't store the normalized name on them
+@cache
 def normalize(name: str) -> NormalizedName:
     return NormalizedName(normalizer.sub("-", name).lower())
 
 
+def install_uvloop():
+    """Use uvloop for the entrypoints if it's installed, it has less overhead per
+    request than the default event loop"""
+    try:
+        import uvloop
+    except ImportError:
+        logger.debug("uvloop is not installed, using the default event loop")
+        return
+    uvloop.install()
+
+
 class Cache:
     """Quick and simple cache abstraction that can be turned off for the tests"""
 
@@ -27,6 +51,8 @@ class Cache:
     read: bool
     write: bool
     refresh_versions: bool
+    # None means the system default temp dir
+    tmp_root: Path | None
 
     def __init__(
         self,
@@ -34,11 +60,13 @@ class Cache:
         read: bool = True,
         write: bool = True,
         refresh_versions: bool = False,
+        tmp_root: Path | None = default_tmp_root,
     ):
         self.root_cache_dir = root_cache_dir
         self.read = read
         self.write = write
         self.refresh_versions = refresh_versions
+        self.tmp_root = tmp_root
 
     def path(self, bucket: str, name: str) -> Path:
         return self.root_cache_dir.joinpath(bucket).joinpath(name)
@@ -3,21 +3,21 @@ import json
 import logging
 import re
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from typing import TYPE_CHECKING
+from collections.abc import Awaitable
+from typing import TYPE_CHECKING, TypeVar
 
-import httpx
-from httpx import AsyncBaseTransport, AsyncClient
+from httpx import AsyncClient
 
-from pypi_types import core_metadata
+from pypi_types import core_metadata, parse_requirements, pypi_releases
 from pypi_types.pep440_rs import Version
 from pypi_types.pep508_rs import Pep508Error, Requirement
 from resolve_prototype import Cache
-from resolve_prototype.common import NormalizedName, normalize
+from resolve_prototype.common import MAX_CONCURRENT_REQUESTS, NormalizedName
 from resolve_prototype.package_index import (
+    get_metadata_from_sidecar,
     get_metadata_from_wheel,
     get_releases,
-    get_metadata,
+    get_requires_dist,
     get_files_for_version,
 )
 
@@ -26,8 +26,13 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
 
-async def get_deps_for_versions(state: "State", cache: Cache):
+# A version directly followed by another operator, e.g. `>=7.2.0<8.0.0`
+missing_comma = re.compile(r"(\d)([<>=~^!])")
+
+
+async def get_deps_for_versions(state: "State", cache: Cache, client: AsyncClient):
     missing: list[tuple[str, Version]] = []
     for name, (version, _extras) in state.candidates.items():
         # Check if it's already loaded
@@ -36,17 +41,20 @@ async def get_deps_for_versions(state: "State", cache: Cache):
 
         # Check if it's in the cache
         if cached := cache.get("requirements", f"{name}@{version}.json"):
-            requirements = [Requirement(req) for req in json.loads(cached)]
+            requirements = parse_requirements(json.loads(cached))
             add_credible_requirements(state, name, version, requirements)
             continue
 
         missing.append((name, version))
     if missing:
-        await query_wheel_metadata(state, cache, missing)
+        await query_wheel_metadata(state, cache, missing, client)
 
 
 async def query_wheel_metadata(
-    state: "State", cache: Cache, missing: list[tuple[str, Version]]
+    state: "State",
+    cache: Cache,
+    missing: list[tuple[str, Version]],
+    client: AsyncClient,
 ):
     """Actually download the wheel metadata from the exact section of the zip.
 
@@ -65,44 +73,57 @@ async def query_wheel_metadata(
     contains `setuptools` in the METADATA file in the wheel.
     """
     # Check the packages with wheels with empty requires_dist, they might not be so
-    # empty after all (name, version, filename, url, cache)
-    query_wheels: list[tuple[str, Version, str, str, Cache]] = []
+    # empty after all.
+    names: list[str] = []
+    versions: list[Version] = []
+    filenames: list[str] = []
+    urls: list[str] = []
     for name, version in missing:
         for file in get_files_for_version(cache, name, version):
             if file.filename.endswith(".whl"):
-                query_wheels.append((name, version, file.filename, file.url, cache))
+                names.append(name)
+                versions.append(version)
+                filenames.append(file.filename)
+                urls.append(file.url)
                 # TODO(konstin): Make sure it's an all-or-nothing per release here
                 break
 
-    logger.info(f"Validating wheel metadata for {len(query_wheels)} packages")
+    logger.info(f"Validating wheel metadata for {len(names)} packages")
 
-    logger.debug("get_metadata_from_wheel with ThreadPoolExecutor (not all cached)")
-    # ZipFile doesn't support async :/
-    with ThreadPoolExecutor() as executor:
-        metadatas = executor.map(
-            get_metadata_from_wheel, *zip(*query_wheels, strict=True)
-        )
+    # Only the range requests are async, zipfile reads the fetched ranges synchronously
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def bounded(
+        name: NormalizedName, version: Version, filename: str, url: str
+    ) -> core_metadata.Metadata21 | RuntimeError:
+        async with semaphore:
+            return await get_metadata_from_wheel(
+                client, name, version, filename, url, cache
+            )
+
+    metadatas = await asyncio.gather(*map(bounded, names, versions, filenames, urls))
 
     # (name, version) -> list[(url, metadata)]
     by_candidate: dict[
         tuple[NormalizedName, Version], list[tuple[str, core_metadata.Metadata21]]
     ] = defaultdict(list)
-    for metadata, (name, version, _filename, url, _cache) in zip(
-        metadatas, query_wheels, strict=True
+    for metadata, name, version, url in zip(
+        metadatas, names, versions, urls, strict=True
     ):
         if isinstance(metadata, Exception):
             logger.warning(
                 f"Failed to parse METADATA for {name} {version} in {url}, "
                 f"removing it from the selection: {metadata}"
             )
-            state.versions_cache_new[name].pop(version)
-            state.queue.append(name)
+            state.versions_cache_new[name].remove(version)
+            state.enqueue(name)
         else:
             by_candidate[(name, version)].append((url, metadata))
     for (name, version), metadatas in by_candidate.items():
         # TODO: actually check all wheels per release here
         metadata = metadatas[0][1]
-        for url, other_metadata in metadatas:
+        # Currently we only query one wheel per release, so this is usually empty
+        for url, other_metadata in metadatas[1:]:
             assert metadata == other_metadata, (
                 name,
                 version,
@@ -111,9 +132,29 @@ async def query_wheel_metadata(
                 url,
                 other_metadata,
             )
+        cache_requirements(cache, name, version, metadata.requires_dist)
         add_credible_requirements(state, name, version, metadata.requires_dist)
 
 
+def cache_requirements(
+    cache: Cache,
+    name: str,
+    version: Version,
+    requirements: list[Requirement],
+    bucket: str = "requirements",
+):
+    """Store credible requirements, i.e. those from a wheel METADATA file, for the next
+    run, where `get_deps_for_versions` and `fetch_versions_and_metadata` pick them
+    up. The requirements from the pypi json api (after the fixups) go to the
+    `pypi_requirements` bucket instead, so we don't need to parse the whole json again
+    """
+    cache.set(
+        bucket,
+        f"{name}@{version}.json",
+        json.dumps([str(requirement) for requirement in requirements]),
+    )
+
+
 def add_credible_requirements(
     state: "State", name: str, version: Version, requirements: list[Requirement]
 ):
@@ -127,8 +168,7 @@ def add_credible_requirements(
         return
 
     state.changed_metadata[(name, version)] = old_requirements
-    if name not in state.queue:
-        state.queue.append(name)
+    state.enqueue(name)
 
     if not old_requirements:
         logger.debug(f"Missing requires_dist pypi metadata for {name} {version}")
@@ -139,27 +179,12 @@ def add_credible_requirements(
             f"pypi json api: {old_requirements}\n"
             f"wheel metadata: {requirements}"
         )
-    for removed in set(old_requirements) - set(requirements):
-        if (removed, (name, version)) in state.requirements_per_package[
-            normalize(removed.name)
-        ]:
-            state.requirements_per_package[normalize(removed.name)].remove(
-                (removed, (name, version))
-            )
-        if name not in state.queue:
-            state.queue.append(name)
-    for added in set(old_requirements) - set(requirements):
-        state.requirements_per_package[normalize(added.name)].add(
-            (added, (name, version))
-        )
-        if name not in state.queue:
-            state.queue.append(name)
-    if name not in state.queue:
-        state.queue.append(name)
+    # `update_single_package` replaces the edges from `changed_metadata`, where the
+    # markers of the old and new requirements are checked
 
 
 async def fetch_versions_and_metadata(
-    state: "State", cache: Cache, transport: AsyncBaseTransport
+    state: "State", cache: Cache, client: AsyncClient
 ):
     logger.info(
         f"Fetching versions for {len(state.fetch_versions)} project(s) and "
@@ -167,36 +192,126 @@ async def fetch_versions_and_metadata(
     )
     # noinspection PyTypeChecker
     state.fetch_metadata = dict(sorted(state.fetch_metadata.items()))
-    timeout = httpx.Timeout(10.0, connect=10.0)
+    fetch_versions = sorted(state.fetch_versions)
 
-    async with AsyncClient(http2=True, transport=transport, timeout=timeout) as client:
-        projects_releases = [
-            await get_releases(state, client, name, cache)
-            for name in sorted(state.fetch_versions)
-        ]
+    # Instead of firing all requests at once, keep a fixed number in flight and start
+    # the next one as soon as any finished
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-        projects_metadata = await asyncio.gather(
+    async def bounded(coro: Awaitable[T]) -> T:
+        async with semaphore:
+            return await coro
+
+    # PEP 658: If the index serves the METADATA of a wheel separately, we take the
+    # requirements from there instead of the json api. Those are credible, so we also
+    # don't need to validate them against the wheel later
+    fetch_json: dict[NormalizedName, Version] = {}
+    fetch_sidecar: dict[NormalizedName, tuple[Version, pypi_releases.File]] = {}
+    for name, version in state.fetch_metadata.items():
+        # Releases are immutable, so credible requirements from a previous run can be
+        # used without any request
+        if cached := cache.get("requirements", f"{name}@{version}.json"):
+            state.requirements[(name, version)] = parse_requirements(json.loads(cached))
+            state.requirements_credible.add((name, version))
+            continue
+        if cached := cache.get("pypi_requirements", f"{name}@{version}.json"):
+            state.requirements[(name, version)] = parse_requirements(json.loads(cached))
+            continue
+        if version not in state.files_cache.setdefault(name, {}):
+            state.files_cache[name][version] = get_files_for_version(
+                cache, name, version
+            )
+        for file in state.files_cache[name][version]:
+            if file.filename.endswith(".whl") and file.has_metadata_file():
+                fetch_sidecar[name] = (version, file)
+                break
+        else:
+            fetch_json[name] = version
+
+    # Versions we guess we'll need next, only through the json api and without failing
+    # the resolution if something is wrong with them. The selection of this round is
+    # settled at this point, so we skip what we're fetching anyway
+    prefetch: list[tuple[NormalizedName, Version]] = []
+    for name, versions in state.prefetch_metadata.items():
+        for version in versions:
+            if state.fetch_metadata.get(name) == version:
+                continue
+            if cached := cache.get("requirements", f"{name}@{version}.json"):
+                requirements = parse_requirements(json.loads(cached))
+                state.requirements[(name, version)] = requirements
+                state.requirements_credible.add((name, version))
+            elif cached := cache.get("pypi_requirements", f"{name}@{version}.json"):
+                requirements = parse_requirements(json.loads(cached))
+                state.requirements[(name, version)] = requirements
+            elif (name, version) not in state.requirements:
+                prefetch.append((name, version))
+    state.prefetch_metadata.clear()
+
+    (
+        projects_releases,
+        projects_requires_dist,
+        sidecar_metadata,
+        prefetched_requires_dist,
+    ) = await asyncio.gather(
+        asyncio.gather(
             *[
-                get_metadata(client, name, version, cache)
-                for name, version in state.fetch_metadata.items()
+                bounded(get_releases(state, client, name, cache))
+                for name in fetch_versions
             ]
-        )
-    state.versions_cache_new.update(
-        dict(zip(sorted(state.fetch_versions), projects_releases, strict=True))
+        ),
+        asyncio.gather(
+            *[
+                bounded(get_requires_dist(client, name, version, cache))
+                for name, version in fetch_json.items()
+            ]
+        ),
+        asyncio.gather(
+            *[
+                bounded(get_metadata_from_sidecar(client, name, version, file, cache))
+                for name, (version, file) in fetch_sidecar.items()
+            ]
+        ),
+        asyncio.gather(
+            *[
+                bounded(get_requires_dist(client, name, version, cache))
+                for name, version in prefetch
+            ],
+            return_exceptions=True,
+        ),
     )
+    for name, versions in zip(fetch_versions, projects_releases, strict=True):
+        # Sort once here instead of on every visit of the package
+        versions.sort()
+        state.versions_cache_new[name] = versions
     # we got the info where we delayed previously, now actually compute a candidate
     # version
-    state.queue.extend(state.fetch_versions)
+    for name in fetch_versions:
+        state.enqueue(name)
     state.fetch_versions.clear()
 
-    for (name, version), metadata in zip(
-        state.fetch_metadata.items(), projects_metadata, strict=True
+    for (name, (version, file)), metadata in zip(
+        fetch_sidecar.items(), sidecar_metadata, strict=True
+    ):
+        if isinstance(metadata, Exception):
+            logger.warning(
+                f"Failed to parse METADATA for {name} {version} in {file.url}, "
+                f"skipping this release: {metadata}"
+            )
+            # Take this version out of the rotation
+            state.versions_cache_new[name].remove(version)
+            state.enqueue(name)
+        else:
+            state.requirements[(name, version)] = metadata.requires_dist
+            state.requirements_credible.add((name, version))
+            cache_requirements(cache, name, version, metadata.requires_dist)
+
+    for (name, version), requires_dist in zip(
+        fetch_json.items(), projects_requires_dist, strict=True
     ):
         try:
-            state.requirements[(name, version)] = [
-                parse_requirement_fixup(requirement, f"{name} {version}")
-                for requirement in metadata.requires_dist or []
-            ]
+            requirements = parse_requirements_fixup(
+                requires_dist or [], f"{name} {version}"
+            )
         except Pep508Error as err:
             logger.warning(
                 f"Invalid requirements for {name} {version}, "
@@ -204,11 +319,30 @@ async def fetch_versions_and_metadata(
             )
             # Take this version out of the rotation
             state.versions_cache_new[name].remove(version)
-            if name not in state.queue:
-                state.queue.append(name)
+            state.enqueue(name)
+        else:
+            state.requirements[(name, version)] = requirements
+            cache_requirements(cache, name, version, requirements, "pypi_requirements")
+    for (name, version), requires_dist in zip(
+        prefetch, prefetched_requires_dist, strict=True
+    ):
+        if isinstance(requires_dist, Exception):
+            logger.debug(
+                f"Failed to prefetch metadata for {name} {version}: {requires_dist}"
+            )
+            continue
+        try:
+            requirements = parse_requirements_fixup(requires_dist or [], None)
+        except Pep508Error as err:
+            # This will be reported if we actually pick this version
+            logger.debug(f"Invalid requirements for {name} {version}: {err}")
+        else:
+            state.requirements[(name, version)] = requirements
+            cache_requirements(cache, name, version, requirements, "pypi_requirements")
     # we got the info where we delayed previously, now actually propagate those
     # requirements
-    state.queue.extend(set(state.fetch_metadata) - set(state.queue))
+    for name in state.fetch_metadata:
+        state.enqueue(name)
     state.fetch_metadata.clear()
 
 
@@ -222,11 +356,12 @@ def parse_requirement_fixup(requirement: str, debug_source: str | None) -> Requi
     try:
         return Requirement(requirement)
     except Pep508Error:
+        # Without a match, the fixup would parse the same string again
+        if not missing_comma.search(requirement):
+            raise
         try:
             # Add the missing comma
-            requirement_parsed = Requirement(
-                re.sub(r"(\d)([<>=~^!])", r"\1,\2", requirement)
-            )
+            requirement_parsed = Requirement(missing_comma.sub(r"\1,\2", requirement))
 
         except Pep508Error:
             pass
@@ -239,3 +374,17 @@ def parse_requirement_fixup(requirement: str, debug_source: str | None) -> Requi
             return requirement_parsed
         # Didn't work with the fixup either? raise the error with the original string
         raise
+
+
+def parse_requirements_fixup(
+    requirements: list[str], debug_source: str | None
+) -> list[Requirement]:
+    """Parse all requirements with a single call into rust, and only if one of them is
+    invalid go through `parse_requirement_fixup` for each"""
+    try:
+        return parse_requirements(requirements)
+    except ValueError:
+        return [
+            parse_requirement_fixup(requirement, debug_source)
+            for requirement in requirements
+        ]
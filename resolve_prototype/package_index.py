@@ -3,20 +3,20 @@ import logging
 import random
 import string
 import time
-from collections import defaultdict
+from collections.abc import Iterable
+from hashlib import sha256
 from pathlib import Path
 from typing import BinaryIO
 import typing
 from zipfile import ZipFile
 
-import httpx
-from httpx import AsyncClient
+from httpx import AsyncClient, HTTPError
 
 from pypi_types import (
     pypi_metadata,
     pypi_releases,
     pep440_rs,
-    filename_to_version,
+    parse_releases_bytes,
     core_metadata,
     write_parsed_release_data,
 )
@@ -28,35 +28,56 @@ if typing.TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# Enough for the end of central directory record with the maximum comment size
+# (64KiB), the zip64 records and usually also the central directory and METADATA
+WHEEL_TAIL_SIZE = 128 * 1024
+# Bound the number of round trips for a single wheel
+MAX_WHEEL_RANGE_REQUESTS = 5
+
+
+class MissingRange(Exception):
+    """The part of the zip file that zipfile wants to read wasn't fetched yet"""
+
+    def __init__(self, start: int, end: int):
+        super().__init__(f"Missing range {start}-{end}")
+        self.start = start
+        self.end = end
+
 
 # noinspection PyAbstractClass
-class RemoteZipFile(BinaryIO):
-    """Pretend local zip file that is actually querying the pypi for the exact ranges of
-    the file. Requirement is that the server supports range requests
-    (https://developer.mozilla.org/en-US/docs/Web/HTTP/Range_requests)
+class PrefetchedZipFile(BinaryIO):
+    """Pretend local zip file of which we only have the ranges that we previously
+    fetched with (async) range requests
+    (https://developer.mozilla.org/en-US/docs/Web/HTTP/Range_requests). zipfile is
+    sync, so when it reads a range we don't have, we raise `MissingRange`, fetch the
+    range and let zipfile try again.
 
     Only implements the methods actually called by zipfile for what we do, we're lying
     about the type here
     """
 
-    url: str
     pos: int
     len: int
-    user_agent = user_agent
+    # Sorted, non-overlapping (start, data) pairs
+    chunks: list[tuple[int, bytes]]
 
-    def __init__(self, client: httpx.Client, url: str):
-        self.url = url
+    def __init__(self, length: int):
         self.pos = 0
-        self.client = client
-
-        response = self.client.head(self.url, headers={"user-agent": self.user_agent})
-        response.raise_for_status()
-        accept_ranges = response.headers.get("accept-ranges")
-        assert accept_ranges == "bytes", (
-            "The server needs to `accept-ranges: bytes`, "
-            f"but it says {accept_ranges} for {url}"
-        )
-        self.len = int(response.headers["content-length"])
+        self.len = length
+        self.chunks = []
+
+    def add(self, start: int, data: bytes):
+        """Add a fetched range, merging it with overlapping or adjacent ranges"""
+        chunks = sorted([*self.chunks, (start, data)])
+        merged = [chunks[0]]
+        for start, data in chunks[1:]:
+            last_start, last_data = merged[-1]
+            last_end = last_start + len(last_data)
+            if start <= last_end:
+                merged[-1] = (last_start, last_data + data[last_end - start :])
+            else:
+                merged.append((start, data))
+        self.chunks = merged
 
     def seekable(self):
         return True
@@ -76,24 +97,45 @@ class RemoteZipFile(BinaryIO):
         return self.pos
 
     def read(self, size: int | None = None):
-        # Here we could also use an end-open range, but we already have the information,
-        # so let's keep track locally (which we when in doubt we can trust over the
-        # server)
-        if size:
-            read_len = size
+        if size is None or size < 0:
+            end = self.len
         else:
-            read_len = self.len - self.pos
-        # HTTP Ranges are zero-indexed and inclusive
-        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Range
-        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Range_requests
-        headers = {
-            "Range": f"bytes={self.pos}-{self.pos + read_len - 1}",
-            "user-agent": self.user_agent,
-        }
-        response = self.client.get(self.url, headers=headers)
-        data = response.read()
-        self.pos += read_len
-        return data
+            end = min(self.pos + size, self.len)
+        for start, data in self.chunks:
+            if start <= self.pos and end <= start + len(data):
+                result = data[self.pos - start : end - start]
+                self.pos = end
+                return result
+        raise MissingRange(self.pos, end)
+
+
+def get_cached_releases(cache: Cache, project: str) -> list[pep440_rs.Version] | None:
+    """The versions from the cache if we have them and don't want to refresh them.
+    Sync, so the resolver can check it without a network round"""
+    if cache.refresh_versions:
+        return None
+    # normalize removes all dots in the name
+    cached = cache.get_path("pypi_simple_releases", normalize(project))
+    if not cached or not cached.is_dir():
+        return None
+    return pypi_releases.versions_from_json(
+        cached.joinpath("versions.json").read_bytes()
+    )
+
+
+def cached_releases_digest(cache: Cache, projects: Iterable[str]) -> str | None:
+    """A hash over the cached version lists of `projects`, or `None` if one is
+    missing. It changes whenever one of the version lists was refreshed"""
+    digest = sha256()
+    for project in sorted(normalize(project) for project in projects):
+        cached = cache.get_path("pypi_simple_releases", project)
+        if not cached:
+            return None
+        try:
+            digest.update(cached.joinpath("versions.json").read_bytes())
+        except FileNotFoundError:
+            return None
+    return digest.hexdigest()
 
 
 async def get_releases(
@@ -117,13 +159,17 @@ async def get_releases(
         .joinpath(normalize(project))
         .joinpath("versions.json")
     )
-    if cached and cached.is_dir() and not refresh and not cache.refresh_versions:
-        # return [Version(version) for version in json.loads(versions_json.read_text())]
-        return pypi_releases.versions_from_json(versions_json.read_bytes())
+    if not refresh and (versions := get_cached_releases(cache, project)) is not None:
+        return versions
 
     logger.debug(f"Querying releases from {url}")
 
-    headers = {"user-agent": user_agent}
+    # The query parameter is a pypi extension, other indexes only do PEP 691 content
+    # negotiation through the accept header
+    headers = {
+        "user-agent": user_agent,
+        "accept": "application/vnd.pypi.simple.v1+json",
+    }
     if cached:
         etag = cached.joinpath("etag.txt")
         if etag.is_file():
@@ -200,42 +246,25 @@ def get_files_for_version(
 def parse_releases_data(
     project: str, data: bytes
 ) -> dict[pep440_rs.Version, list[pypi_releases.File]]:
-    data: pypi_releases.PypiReleases = pypi_releases.parse(data)
-    assert data.meta.api_version in [
-        "1.0",
-        "1.1",
-    ], f"Unsupported api version {data.meta.api_version}"
-    releases: dict[pep440_rs.Version, list[pypi_releases.File]] = defaultdict(list)
-    ignored = list()
-    invalid_versions = []
-    for file in data.files:
-        # true or some string reason
-        if file.yanked:
-            continue
-
-        if version := filename_to_version(project, file.filename):
-            try:
-                version = pep440_rs.Version(version)
-            except ValueError:
-                invalid_versions.append(version)
-                continue
-            releases[version].append(file)
-        else:
-            ignored.append(file.filename)
+    # Skipping yanked files and grouping by the version from the filename happens in
+    # rust, a python loop would cross into rust twice for each file
+    releases, ignored, invalid_versions = parse_releases_bytes(project, data)
     if invalid_versions:
         logger.debug(f"{project} has invalid versions: {invalid_versions}")
     logger.debug(f"Ignoring files with unknown extensions: {ignored}")
-    # 10 most recent versions
-    top10 = [str(release) for release in list(releases.keys())[::-1][:10]]
+    # 10 most recent versions, the releases from rust are unordered
+    top10 = [str(release) for release in sorted(releases, reverse=True)[:10]]
     logger.debug(
         f"Found {project} with {len(releases)} releases {', '.join(top10)}, ..."
     )
-    return dict(releases)
+    return releases
 
 
-async def get_metadata(
+async def get_requires_dist(
     client: AsyncClient, project: str, version: pep440_rs.Version, cache: Cache
-) -> pypi_metadata.Metadata:
+) -> list[str] | None:
+    """The requires_dist from the pypi json api. We only deserialize that field, the
+    remainder of the json (e.g. the description) is skipped"""
     url = f"https://pypi.org/pypi/{normalize(project)}/{version}/json"
 
     cached = cache.get_bytes(
@@ -254,7 +283,7 @@ async def get_metadata(
         )
         data = data.encode()
     try:
-        return pypi_metadata.parse(data).info
+        return pypi_metadata.parse_requires_dist(data)
     except Exception as err:
         raise RuntimeError(
             f"Failed to parse metadata for {project} {version}, "
@@ -262,7 +291,46 @@ async def get_metadata(
         ) from err
 
 
-def get_metadata_from_wheel(
+async def get_metadata_from_sidecar(
+    client: AsyncClient,
+    name: NormalizedName,
+    version: pep440_rs.Version,
+    file: pypi_releases.File,
+    cache: Cache,
+) -> core_metadata.Metadata21 | RuntimeError:
+    """PEP 658: Read the METADATA of a wheel that the index serves separately at
+    `{url}.metadata`, so we don't need to touch the wheel itself. If that fails, we
+    fall back to the range requests on the wheel."""
+    # Shared with `get_metadata_from_wheel`, it's the same file
+    cache_name = f"{file.filename.split('/')[0]}.json"
+    metadata_json = cache.get_bytes("wheel_metadata", cache_name)
+    try:
+        if metadata_json:
+            return core_metadata.Metadata21.from_json(metadata_json)
+
+        url = file.url + ".metadata"
+        logger.debug(f"Querying {url}")
+        try:
+            response = await client.get(url, headers={"user-agent": user_agent})
+            response.raise_for_status()
+        except HTTPError as err:
+            # The index advertised the file, but it's missing or the request failed
+            logger.warning(f"Failed to fetch {url}, reading the wheel instead: {err}")
+            return await get_metadata_from_wheel(
+                client, name, version, file.filename, file.url, cache
+            )
+        metadata = core_metadata.Metadata21.from_bytes(
+            response.content, f"{name} {version}"
+        )
+    except RuntimeError as err:
+        # Let the caller handle this like the errors from `get_metadata_from_wheel`
+        return err
+    cache.set("wheel_metadata", cache_name, metadata.to_json())
+    return metadata
+
+
+async def get_metadata_from_wheel(
+    client: AsyncClient,
     name: NormalizedName,
     version: pep440_rs.Version,
     filename: str,
@@ -279,36 +347,79 @@ def get_metadata_from_wheel(
         try:
             return core_metadata.Metadata21.from_json(metadata_json)
         except RuntimeError as err:
-            # Let the caller across the thread pool executor handle the call
+            # Let the caller handle this
             return err
 
     logger.debug(f"Querying {url}")
-    # Create a new client because we're running in a thread
-    with httpx.Client() as client:
-        zipfile = ZipFile(RemoteZipFile(client, url))
+    # The end of central directory record is at most 64KiB (the comment) away from the
+    # end. For most wheels, the tail also contains the central directory and METADATA,
+    # so one request suffices
+    headers = {"Range": f"bytes=-{WHEEL_TAIL_SIZE}", "user-agent": user_agent}
+    response = await client.get(url, headers=headers)
+    response.raise_for_status()
+    if response.status_code == 206:
+        # e.g. `bytes 1000-1999/2000`
+        length = int(response.headers["content-range"].rsplit("/", 1)[1])
+    else:
+        # The server ignored the range and sent us the whole file
+        length = len(response.content)
+    zip_file = PrefetchedZipFile(length)
+    zip_file.add(length - len(response.content), response.content)
+
+    for _ in range(MAX_WHEEL_RANGE_REQUESTS):
         try:
-            metadata_bytes = zipfile.read(metadata_path)
-        except KeyError:
-            metadata_bytes = None
-            for zipped_file in zipfile.namelist():
-                # TODO: Check that there's actually exactly one dist info directory
-                #       and METADATA file
-                if zipped_file.count("/") == 1 and zipped_file.endswith(
-                    ".dist-info/METADATA"
-                ):
-                    metadata_bytes = zipfile.read(zipped_file)
-                    break
-            if not metadata_bytes:
-                raise RuntimeError(
-                    f"Missing METADATA file for {name} {version} {filename} {url}"
-                ) from None
+            metadata_bytes = read_metadata_from_zip(
+                zip_file, metadata_path, name, version, filename, url
+            )
+            break
+        except MissingRange as err:
+            # Fetch a bit more so we don't need another request for the next read
+            end = min(max(err.end, err.start + WHEEL_TAIL_SIZE), length)
+            headers = {
+                # HTTP Ranges are zero-indexed and inclusive
+                # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Range
+                "Range": f"bytes={err.start}-{end - 1}",
+                "user-agent": user_agent,
+            }
+            response = await client.get(url, headers=headers)
+            response.raise_for_status()
+            if response.status_code == 206:
+                zip_file.add(err.start, response.content)
+            else:
+                # The server ignored the range and sent us the whole file
+                zip_file.add(0, response.content)
+    else:
+        raise RuntimeError(
+            f"Too many range requests reading METADATA for {name} {version} from {url}"
+        )
 
     metadata = core_metadata.Metadata21.from_bytes(metadata_bytes)
     cache.set("wheel_metadata", f"{filename.split('/')[0]}.json", metadata.to_json())
     end = time.time()
     logger.debug(f"Getting metadata took {end - start:.2f}s from {url}")
+    return metadata
+
+
+def read_metadata_from_zip(
+    zip_file: PrefetchedZipFile,
+    metadata_path: str,
+    name: NormalizedName,
+    version: pep440_rs.Version,
+    filename: str,
+    url: str,
+) -> bytes:
+    """Raises `MissingRange` if we need to fetch more of the file"""
+    zipfile = ZipFile(zip_file)
     try:
-        return metadata
-    except RuntimeError as err:
-        # Let the caller across the thread pool executor handle the call
-        return err
+        return zipfile.read(metadata_path)
+    except KeyError:
+        for zipped_file in zipfile.namelist():
+            # TODO: Check that there's actually exactly one dist info directory
+            #       and METADATA file
+            if zipped_file.count("/") == 1 and zipped_file.endswith(
+                ".dist-info/METADATA"
+            ):
+                return zipfile.read(zipped_file)
+        raise RuntimeError(
+            f"Missing METADATA file for {name} {version} {filename} {url}"
+        ) from None
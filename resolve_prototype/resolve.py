@@ -2,9 +2,10 @@
 we vist, we compute the outgoing edges (requires_dist) from incoming edge information
 (version constraints and activated extras). The root is the user input. Each time we
 give a new or change an incoming edge by this procedure we mark the node for revisiting
-(breadth-first search). Given that we sometimes have to hold and wait for the network or
-worse build a sdist to know the outgoing edges of a new output translation for nodes
-we collect as many of those cases as possible and then query them in parallel.
+(breadth-first search, preferring the packages closest to the root). Given that we
+sometimes have to hold and wait for the network or worse build a sdist to know the
+outgoing edges of a new output translation for nodes we collect as many of those cases
+as possible and then query them in parallel.
 
 We have three kinds of information we query:
 * The versions (and files) that exist for each release: One query per release (fast)
@@ -39,24 +40,33 @@ When the queue is still empty:
 """
 
 import asyncio
+import json
 import logging
+import os
 import sys
 import time
 from argparse import ArgumentParser
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, Executor
+from collections import defaultdict, deque
 from dataclasses import dataclass
+from hashlib import sha256
+from heapq import heappop, heappush
 from collections.abc import Iterable
 from typing import Any
 
 import httpx
-import tomli_w
 
-from pypi_types import pypi_releases
+from pypi_types import (
+    core_metadata,
+    count_versions,
+    parse_requirements,
+    pick_version,
+    pypi_releases,
+)
 from pypi_types.pep440_rs import Version, VersionSpecifiers
 from pypi_types.pep508_rs import Requirement, MarkerEnvironment
 from resolve_prototype.common import (
     default_cache_dir,
+    install_uvloop,
     Cache,
     MINIMUM_SUPPORTED_PYTHON_MINOR,
     NormalizedName,
@@ -67,8 +77,12 @@ from resolve_prototype.metadata import (
     get_deps_for_versions,
     fetch_versions_and_metadata,
 )
-from resolve_prototype.package_index import get_files_for_version
-from resolve_prototype.sdist import build_sdists
+from resolve_prototype.package_index import (
+    cached_releases_digest,
+    get_cached_releases,
+    get_files_for_version,
+)
+from resolve_prototype.sdist import finish_sdist_builds, start_sdist_builds
 
 logger = logging.getLogger(__name__)
 
@@ -77,18 +91,38 @@ class State:
     root_requirement: Requirement
     user_constraints: dict[NormalizedName, list[Requirement]]
 
-    # The list of packages which we need to reevaluate
-    queue: list[NormalizedName]
+    # Heap of (depth, remaining candidates, name) of the packages which we need to
+    # reevaluate. Packages close to the root go first, so their pins are fixed before we
+    # revisit their dependencies. On the same level, we take the packages with the
+    # fewest versions matching their requirements first (like cargo), they are the
+    # most constrained. The entries aren't updated while queued, so the order is a
+    # heuristic only
+    queue: list[tuple[int, int, NormalizedName]]
+    # The same packages as in `queue`, for fast membership checks
+    queued: set[NormalizedName]
     # Process after fetching additional information
     fetch_versions: set[NormalizedName]
     # The idea of a dict is that we can query a version to fetch, but if something
     # further back in the queue requires a different version constraint it gets updated
     # before fetching the now useless version
     fetch_metadata: dict[NormalizedName, Version]
+    # Packages that got downgraded repeatedly (e.g. botocore) are likely to be
+    # downgraded again, so we fetch the metadata for the next lower versions in the same
+    # batch as `fetch_metadata`. name -> number of downgrades
+    downgrades: dict[NormalizedName, int]
+    prefetch_metadata: dict[NormalizedName, list[Version]]
     # remember which sdist we did already process
     resolved_sdists: set[tuple[NormalizedName, Version]]
+    # The sdist builds that are still running in the background
+    sdist_builds: dict[
+        tuple[NormalizedName, Version], asyncio.Task[core_metadata.Metadata21]
+    ]
+    # The PEP 517 hooks already run in their own python processes, so the builds are
+    # parallel, but we don't want to run more of them at once than we have cores
+    sdist_semaphore: asyncio.Semaphore
 
-    # package name -> list of versions and the files (sdist and wheel only) from pypi
+    # package name -> list of versions (sorted ascending) and the files (sdist and
+    # wheel only) from pypi
     versions_cache_new: dict[NormalizedName, list[Version]]
     files_cache: dict[NormalizedName, dict[Version, list[pypi_releases.File]]]
     # The requirements for specific package version, either `requiress_dist`
@@ -101,33 +135,57 @@ class State:
     # Stores a list of the old requirements so we can remove them
     changed_metadata: dict[tuple[NormalizedName, Version], list[Requirement]]
     # Reverse mapping: package name -> requirements. Without version since those are
-    # the ones we determine the version from
+    # the ones we determine the version from. This is a plain dict so that lookups
+    # don't insert empty sets, use `.get` for reading and `add_requirement` and
+    # `remove_requirement` for writing
     requirements_per_package: dict[
         NormalizedName, set[tuple[Requirement, tuple[NormalizedName, Version]]]
     ]
+    # The shortest distance from the root we've seen for each package
+    depth: dict[NormalizedName, int]
+    # Bumped each time the requirements of a package change, so we can cache values
+    # computed from them
+    requirements_revision: dict[NormalizedName, int]
+    # name -> (revision, allowed prereleases) of the last `get_allowed_prereleases`
+    allowed_prereleases: dict[NormalizedName, tuple[int, set[tuple[int]]]]
+    # name -> ((revision, number of versions), version) of the last compatible
+    # version search
+    selected_versions: dict[NormalizedName, tuple[tuple[int, int], Version | None]]
+    # name -> ((revision, number of versions), number of versions matching all
+    # specifiers) for the queue order
+    remaining_candidates: dict[NormalizedName, tuple[tuple[int, int], int]]
     # name -> (version, extras)
     candidates: dict[NormalizedName, tuple[Version, set[str]]]
+    # (requirement, extras) -> whether the markers match. The python versions are the
+    # same for the whole resolution, so they're not part of the key
+    marker_evaluations: dict[tuple[Requirement, frozenset[str]], bool]
 
-    # Currently used to switch out the ThreadPoolExecutor we normally use with the lazy
-    # zip for a DummyExecutor
-    executor: type[Executor]
-
-    def __init__(self, root_requirement: Requirement, executor: type[Executor]):
+    def __init__(self, root_requirement: Requirement):
         self.root_requirement = root_requirement
         self.user_constraints = {normalize(root_requirement.name): [root_requirement]}
-        self.queue = [normalize(root_requirement.name)]
+        self.queue = [(0, 0, normalize(root_requirement.name))]
+        self.queued = {normalize(root_requirement.name)}
         self.fetch_versions = set()
         self.fetch_metadata = {}
+        self.downgrades = {}
+        self.prefetch_metadata = {}
         self.resolved_sdists = set()
+        self.sdist_builds = {}
+        self.sdist_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
         # TODO: remove the _new suffix
         self.versions_cache_new = {}
         self.files_cache = {}
         self.requirements = {}
         self.requirements_credible = set()
         self.changed_metadata = {}
-        self.requirements_per_package = defaultdict(set)
+        self.requirements_per_package = {}
+        self.depth = {normalize(root_requirement.name): 0}
+        self.requirements_revision = {}
+        self.allowed_prereleases = {}
+        self.selected_versions = {}
+        self.remaining_candidates = {}
         self.candidates = {}
-        self.executor = executor
+        self.marker_evaluations = {}
 
         for name, [requirement] in self.user_constraints.items():
             # somehow it doesn't get the list unstructuring
@@ -136,10 +194,85 @@ class State:
                 (requirement, ("(user specified)", Version("0")))
             }
 
+    def add_requirement(
+        self, requirement: Requirement, source: tuple[NormalizedName, Version]
+    ) -> NormalizedName:
+        """Returns the normalized name of the required package, so callers don't need
+        to read and normalize the name again"""
+        name = normalize(requirement.name)
+        self.requirements_per_package.setdefault(name, set()).add((requirement, source))
+        self.depth[name] = min(
+            self.depth.get(name, sys.maxsize), self.depth.get(source[0], 0) + 1
+        )
+        self.requirements_revision[name] = self.requirements_revision.get(name, 0) + 1
+        return name
+
+    def remove_requirement(
+        self, requirement: Requirement, source: tuple[NormalizedName, Version]
+    ) -> NormalizedName:
+        """Like `add_requirement`, returns the normalized name"""
+        name = normalize(requirement.name)
+        self.requirements_per_package[name].remove((requirement, source))
+        self.requirements_revision[name] = self.requirements_revision.get(name, 0) + 1
+        return name
+
+    def evaluate_extras_and_python_version(
+        self,
+        requirement: Requirement,
+        extras: frozenset[str],
+        python_versions: list[Version],
+    ) -> bool:
+        """Memoized `Requirement.evaluate_extras_and_python_version`, we see the same
+        edges with the same extras again each time a package is revisited. The extras
+        are passed frozen so callers can build the key once for all edges"""
+        key = (requirement, extras)
+        if (matches := self.marker_evaluations.get(key)) is None:
+            matches = requirement.evaluate_extras_and_python_version(
+                set(extras), python_versions
+            )
+            self.marker_evaluations[key] = matches
+        return matches
+
+    def enqueue(self, name: NormalizedName):
+        """Mark a package for reevaluation, unless it's already in the queue"""
+        if name not in self.queued:
+            logger.debug(f"Queuing {name}")
+            self.queued.add(name)
+            remaining = self.count_remaining_candidates(name)
+            heappush(self.queue, (self.depth.get(name, 0), remaining, name))
+
+    def count_remaining_candidates(self, name: NormalizedName) -> int:
+        """The number of versions that `pick_version` could pick for the package,
+        cached like `selected_versions`"""
+        versions = self.versions_cache_new.get(name, [])
+        revision = self.requirements_revision.get(name, 0)
+        key = (revision, len(versions))
+        cached_key, remaining = self.remaining_candidates.get(name, (None, 0))
+        if cached_key != key:
+            requirements = self.requirements_per_package.get(name, set())
+            specifiers = [
+                specifier
+                for requirement, _source in requirements
+                for specifier in requirement.version_or_url or []
+            ]
+            # Shared with `update_single_package`, which would compute the same set
+            cached_revision, allowed_prereleases = self.allowed_prereleases.get(
+                name, (None, None)
+            )
+            if cached_revision != revision:
+                allowed_prereleases = get_allowed_prereleases(requirements)
+                self.allowed_prereleases[name] = (revision, allowed_prereleases)
+            remaining = count_versions(versions, specifiers, allowed_prereleases)
+            self.remaining_candidates[name] = (key, remaining)
+        return remaining
+
     @staticmethod
     def assert_list_normalization(data: Iterable[str | NormalizedName]):
-        for entry in data:
-            assert entry == normalize(entry), entry
+        """Debugging helper, a single assert so that it's entirely removed with
+        `python -O`"""
+        assert all(entry == normalize(entry) for entry in data), [
+            entry for entry in data if entry != normalize(entry)
+        ]
 
 
 @dataclass
@@ -176,10 +309,14 @@ class Resolution:
         markers. This is an iterative procedure where each incoming edge comes with a
         set of extras that may change the set of outgoing edges of a node."""
         name_to_version = {name: (name, version) for name, version in self.package_data}
+        # The outgoing edges of each node, so we don't go through the version each time
+        # we (re)visit a package
+        adjacency: dict[NormalizedName, list[Requirement]] = {
+            name: package_data.requirements
+            for (name, _version), package_data in self.package_data.items()
+        }
         # We have starting incoming edges for all root requirements
-        env_root = list(
-            filter(lambda req: req.evaluate_markers(env, root_extras), self.root)
-        )
+        env_root = [req for req in self.root if req.evaluate_markers(env, root_extras)]
         selected: set[NormalizedName] = {normalize(req.name) for req in env_root}
         # name -> extras
         # selected_extras contains only normalized keys
@@ -187,22 +324,39 @@ class Resolution:
         for req in self.root:
             selected_extras[normalize(req.name)].update(req.extras or [])
 
-        already_warned = []
+        # The warnings come from rust and have no value based hash, so we key them by
+        # their string representation
+        already_warned: set[tuple[NormalizedName, Requirement, str]] = set()
+        # Identical requirements (e.g. `typing-extensions; python_version < "3.8"`)
+        # show up for many packages and packages are revisited when extras change
+        marker_evaluations: dict[tuple[Requirement, tuple[str, ...]], Any] = {}
 
         # queue contains only normalized names
         # TODO(konstin): Use a wrapper type around names so we can only compare/index
         #   with the correct normalization
-        queue = [normalize(req.name) for req in env_root]
+        queue = deque(normalize(req.name) for req in env_root)
+        # The same names as `queue`, for constant time membership checks
+        queued: set[NormalizedName] = set(queue)
         while queue:
-            current = queue.pop()
-            for req in self.package_data[name_to_version[current]].requirements:
-                (matches, warnings) = req.evaluate_markers_and_report(
-                    env, sorted(selected_extras[current])
-                )
+            current = queue.popleft()
+            queued.remove(current)
+            # Sorted once per visit instead of once per edge. If an edge of the package
+            # adds extras to itself, the package is queued again
+            current_extras = sorted(selected_extras[current])
+            current_extras_key = tuple(current_extras)
+            for req in adjacency[current]:
+                # The environment is fixed, so the result only depends on the
+                # requirement and the extras
+                marker_key = (req, current_extras_key)
+                if (evaluation := marker_evaluations.get(marker_key)) is None:
+                    evaluation = req.evaluate_markers_and_report(env, current_extras)
+                    marker_evaluations[marker_key] = evaluation
+                (matches, warnings) = evaluation
                 for warning in warnings:
-                    if (current, req, warning) in already_warned:
+                    warning_key = (current, req, str(warning))
+                    if warning_key in already_warned:
                         continue
-                    already_warned.append((current, req, warning))
+                    already_warned.add(warning_key)
                     # TODO: Collect those warnings during dependency resolution, but
                     #   warn only if the version was picked. If so, check the latest
                     #   version. If it is also invalid, prompt the user with the
@@ -219,27 +373,70 @@ class Resolution:
                     # because the markers did not apply to an edge closer to the root
                     # which in turn did not activate the extra
                     continue
+                req_name = normalize(req.name)
+                # Read through pyo3 only once, and `issuperset` doesn't need a set
+                req_extras = req.extras or []
                 add_to_queue = False
-                if normalize(req.name) not in selected:
-                    selected.add(normalize(req.name))
+                if req_name not in selected:
+                    selected.add(req_name)
                     add_to_queue = True
-                if not set(req.extras or []) <= selected_extras[normalize(req.name)]:
-                    selected_extras[normalize(req.name)].update(req.extras)
+                if not selected_extras[req_name].issuperset(req_extras):
+                    selected_extras[req_name].update(req_extras)
                     add_to_queue = True
-                if add_to_queue:
-                    if req.name not in queue:
-                        queue.append(normalize(req.name))
-
-        env_package_data = {}
-        for (name, version), package_data in self.package_data.items():
-            if name in selected:
-                env_package_data[(name, version)] = package_data
+                if add_to_queue and req_name not in queued:
+                    queued.add(req_name)
+                    queue.append(req_name)
+
+        # Sorted to keep the order of `package_data`
+        env_package_data = {
+            name_to_version[name]: self.package_data[name_to_version[name]]
+            for name in sorted(selected)
+        }
 
         return Resolution(root=env_root, package_data=env_package_data)
 
+    def to_json(self, releases_digest: str | None = None) -> str:
+        """`releases_digest` ties a cached resolution to the version lists it was
+        resolved from, `from_json` ignores it"""
+        return json.dumps(
+            {
+                "releases_digest": releases_digest,
+                "root": [str(requirement) for requirement in self.root],
+                "package_data": [
+                    {
+                        "name": name,
+                        "version": str(version),
+                        "unnormalized_name": release_data.unnormalized_name,
+                        "requirements": [str(req) for req in release_data.requirements],
+                        "files": json.loads(
+                            pypi_releases.File.vec_to_json(release_data.files)
+                        ),
+                        "extras": sorted(release_data.extras),
+                    }
+                    for (name, version), release_data in self.package_data.items()
+                ],
+            }
+        )
+
+    @staticmethod
+    def from_json(data: str) -> "Resolution":
+        data = json.loads(data)
+        package_data = {}
+        for release in data["package_data"]:
+            package_data[(release["name"], Version(release["version"]))] = ReleaseData(
+                unnormalized_name=release["unnormalized_name"],
+                requirements=parse_requirements(release["requirements"]),
+                files=pypi_releases.File.vec_from_json(
+                    json.dumps(release["files"]).encode()
+                ),
+                extras=set(release["extras"]),
+            )
+        return Resolution(parse_requirements(data["root"]), package_data)
+
 
 async def update_single_package(
     state: State,
+    cache: Cache,
     name: NormalizedName,
     maximum_versions: bool,
     python_versions: list[Version],
@@ -258,71 +455,75 @@ async def update_single_package(
     logger.debug(f"Processing {name}")
     # First time we're encountering this package?
     if name not in state.versions_cache_new:
-        logger.debug(f"Missing versions for {name}, delaying")
-        state.fetch_versions.add(name)
-        return
+        # If the versions are in the cache, there's no need to wait for the next round
+        if (cached_versions := get_cached_releases(cache, name)) is not None:
+            cached_versions.sort()
+            state.versions_cache_new[name] = cached_versions
+        else:
+            logger.debug(f"Missing versions for {name}, delaying")
+            state.fetch_versions.add(name)
+            return
     # Apply all requirements and find the highest (given `maximum_versions`)
     # possible version
-    new_version = None
+    requirements = state.requirements_per_package.get(name, set())
+    logger.debug(f"{name} {requirements}")
+    # The extras don't depend on the version, and we read the specifiers only once
+    # instead of once per version (each attribute access goes through pyo3)
     new_extras: set[str] = set()
-
-    requirements = state.requirements_per_package[name]
-    allowed_preleases = get_allowed_prereleases(requirements)
-    # Only prereleases? We have to pick a prerelease, so they are all allowed
-    # iirc pip added this behaviour for black. TODO: Find the issue/PR
-    # The all should be fast because it should short-circuit
-    if not allowed_preleases and all(
-        version.any_prerelease() for version in state.versions_cache_new[name]
-    ):
-        allowed_preleases = set(
-            tuple(version.release) for version in state.versions_cache_new[name]
+    specifiers = []
+    for requirement, _source in requirements:
+        new_extras.update(requirement.extras or [])
+        if requirement.version_or_url:
+            specifiers.extend(requirement.version_or_url)
+    # Packages are often requeued without their own requirements changing
+    revision = state.requirements_revision.get(name, 0)
+    versions = state.versions_cache_new[name]
+    # The compatible version only changes when the requirements or the versions
+    # change. After fetching, versions are only ever removed, so the length suffices
+    selection_key = (revision, len(versions))
+    cached_key, new_version = state.selected_versions.get(name, (None, None))
+    if cached_key != selection_key:
+        cached_revision, allowed_preleases = state.allowed_prereleases.get(
+            name, (None, None)
         )
+        if cached_revision != revision:
+            allowed_preleases = get_allowed_prereleases(requirements)
+            state.allowed_prereleases[name] = (revision, allowed_preleases)
+        # Only prereleases? We have to pick a prerelease, so they are all allowed
+        # iirc pip added this behaviour for black. TODO: Find the issue/PR
+        # The all should be fast because it should short-circuit
+        if not allowed_preleases and all(
+            version.any_prerelease() for version in versions
+        ):
+            allowed_preleases = set(tuple(version.release) for version in versions)
 
-    for version in sorted(state.versions_cache_new[name], reverse=maximum_versions):
         # TODO: proper prerelease handling (i.e. check the specifiers if they
         #  have consensus over pulling specific prerelease ranges in)
-        if version.any_prerelease() and tuple(version.release) not in allowed_preleases:
-            continue
-        is_compatible = True
-        extras: set[str] = set()
-
-        logger.debug(f"{name} {version} {state.requirements_per_package[name]}")
-        for requirement, _source in state.requirements_per_package[name]:
-            extras.update(set(requirement.extras or []))
-            if not requirement.version_or_url:
-                continue
-            for specifier in requirement.version_or_url:
-                if not specifier.contains(version):
-                    is_compatible = False
-                    break
-        if is_compatible:
-            new_version = version
-            new_extras = extras
-            break
+        new_version = pick_version(
+            versions, specifiers, maximum_versions, allowed_preleases
+        )
+        state.selected_versions[name] = (selection_key, new_version)
     # TODO: Actually backtrack (pubgrub?)
     if not new_version:
-        constraints = state.requirements_per_package[name]
         constraints = "\n".join(
             sorted(
                 f"    {req} ({requester_name} {requester_version})"
-                for (req, (requester_name, requester_version)) in constraints
+                for (req, (requester_name, requester_version)) in requirements
             )
         )
-        versions = list(
-            str(i).replace("'", "") for i in sorted(state.versions_cache_new[name])
-        )
+        versions_fmt = list(str(i).replace("'", "") for i in versions)
         raise RuntimeError(
             f"No compatible version for {name}.\n"
             f"Constraints:\n{constraints}.\n"
-            f"Versions: {versions}"
+            f"Versions: {versions_fmt}"
         )
-    # If we had the same constraints
-    if (name, new_version) in state.changed_metadata:
-        changed_requirement = state.changed_metadata.pop((name, new_version))
-        logger.debug(f"New wheel metadata for {name} {new_version}")
-    else:
-        changed_requirement = None
     old_version, old_extras = state.candidates.get(name, (None, None))
+    # The edges in the graph are those of the old candidate, if its metadata changed
+    # we need the previous requirements to remove them. It's only popped once the
+    # edges are updated, we might delay below
+    changed_requirement = state.changed_metadata.get((name, old_version))
+    if changed_requirement is not None:
+        logger.debug(f"New wheel metadata for {name} {old_version}")
     if new_version == old_version and new_extras == old_extras:
         if changed_requirement is None:
             logger.info(f"No changes for {name}")
@@ -333,6 +534,8 @@ async def update_single_package(
                 f"Picking {name} {new_version} {new_extras} over"
                 f" {old_version} {old_extras}"
             )
+            if new_version < old_version:
+                state.downgrades[name] = state.downgrades.get(name, 0) + 1
         else:
             logger.debug(f"Picking {name} {new_version} {new_extras}")
     # Do we actually already know the requires_dist for this new candidate?
@@ -340,40 +543,50 @@ async def update_single_package(
         logger.debug(f"Missing metadata for {name} {new_version}, delaying")
         # If we had chosen a higher version to fetch in previous iteration,
         # overwrite
-        state.fetch_metadata[normalize(name)] = new_version
+        state.fetch_metadata[name] = new_version
+        if maximum_versions and (downgrades := state.downgrades.get(name)):
+            # Double the number of prefetched versions with each downgrade
+            lower = [
+                version
+                for version in versions[: versions.index(new_version)]
+                if (name, version) not in state.requirements
+            ]
+            state.prefetch_metadata[name] = lower[-min(16, 2**downgrades) :]
         return
+    # A downgrade in the same round can land on a version we already know, then the
+    # version we had scheduled for fetching is obsolete
+    if (obsolete := state.fetch_metadata.pop(name, None)) is not None:
+        logger.debug(f"Not fetching {name} {obsolete} anymore")
     state.candidates[name] = (new_version, new_extras)
     # Update the outgoing edges
     if old_version:
         if changed_requirement is not None:
             old_requirements = changed_requirement
+            del state.changed_metadata[(name, old_version)]
         else:
             old_requirements = state.requirements[(name, old_version)]
+        old_extras_key = frozenset(old_extras)
         for old in old_requirements:
-            if not old.evaluate_extras_and_python_version(old_extras, python_versions):
+            if not state.evaluate_extras_and_python_version(
+                old, old_extras_key, python_versions
+            ):
                 continue
             # We always need to remove all of them since the version always
             # changed
-            state.requirements_per_package[normalize(old.name)].remove(
-                (old, (name, old_version))
-            )
-
-            if normalize(old.name) not in state.queue:
-                logger.debug(f"Queuing {normalize(old.name)}")
-                state.queue.append(normalize(old.name))
+            state.enqueue(state.remove_requirement(old, (name, old_version)))
     else:
         old_requirements = []
+    new_extras_key = frozenset(new_extras)
     for new in state.requirements[(name, new_version)]:
-        if not new.evaluate_extras_and_python_version(new_extras, python_versions):
+        if not state.evaluate_extras_and_python_version(
+            new, new_extras_key, python_versions
+        ):
             continue
-        state.requirements_per_package[normalize(new.name)].add(
-            (new, (name, new_version))
-        )
+        new_name = state.add_requirement(new, (name, new_version))
         # Same requirement might be in two version of a package, otherwise
         # we need to recompute it
-        if new not in old_requirements and normalize(new.name) not in state.queue:
-            logger.debug(f"Queuing {normalize(new.name)}")
-            state.queue.append(normalize(new.name))
+        if new not in old_requirements:
+            state.enqueue(new_name)
 
 
 def get_allowed_prereleases(
@@ -384,20 +597,20 @@ def get_allowed_prereleases(
     # which may have multiple prereleases, we use sets.
     allowed_preleases = None
     for requirement, _ in requirements:
+        # Each attribute access goes through pyo3, so we read them only once
+        version_or_url = requirement.version_or_url
         # Blank requirements mean prereleases are banned(?, blank requirements are bad)
-        if not requirement.version_or_url:
+        if not version_or_url:
             return set()
         # TODO: url
+        release_with_pre = set()
+        for specifier in version_or_url:
+            version = specifier.version
+            if version.any_prerelease():
+                release_with_pre.add(tuple(version.release))
         # Shortcut
-        if not any(
-            specifier.version.any_prerelease()
-            for specifier in requirement.version_or_url
-        ):
+        if not release_with_pre:
             return set()
-        release_with_pre = set()
-        for specifier in requirement.version_or_url:
-            if specifier.version.any_prerelease():
-                release_with_pre.add(tuple(specifier.version.release))
         if allowed_preleases is None:
             allowed_preleases = release_with_pre
         else:
@@ -406,20 +619,35 @@ def get_allowed_prereleases(
         # Optimization
         if not allowed_preleases:
             return set()
-    return allowed_preleases or {}
+    return allowed_preleases or set()
 
 
 async def find_sdists_for_build(
     state: State, cache: Cache
 ) -> list[tuple[NormalizedName, Version, pypi_releases.File]]:
+    candidates = [
+        (name, version)
+        for name, (version, _extras) in state.candidates.items()
+        if (name, version) not in state.resolved_sdists
+        and (name, version) not in state.sdist_builds
+    ]
+    # Read the missing file lists in parallel instead of one after the other
+    missing = [
+        (name, version)
+        for name, version in candidates
+        if version not in state.files_cache.setdefault(name, {})
+    ]
+    files_lists = await asyncio.gather(
+        *[
+            asyncio.to_thread(get_files_for_version, cache, name, version)
+            for name, version in missing
+        ]
+    )
+    for (name, version), files in zip(missing, files_lists, strict=True):
+        state.files_cache[name][version] = files
+
     sdists = []
-    for name, (version, _extras) in state.candidates.items():
-        if (name, version) in state.resolved_sdists:
-            continue
-        if version not in state.files_cache.setdefault(name, {}):
-            state.files_cache[name][version] = get_files_for_version(
-                cache, name, version
-            )
+    for name, version in candidates:
         if not any(
             file.filename.endswith(".whl") for file in state.files_cache[name][version]
         ):
@@ -436,40 +664,25 @@ async def find_sdists_for_build(
     return sdists
 
 
-async def resolve_requirement(
-    root_requirement: Requirement,
-    requires_python: VersionSpecifiers,
+async def resolve_loop(
+    state: State,
     cache: Cache,
-    download_wheels: bool = True,
-    maximum_versions: bool = True,
-    executor: type[Executor] = ThreadPoolExecutor,
-    transport: httpx.AsyncHTTPTransport | None = None,
-) -> Resolution:
-    if not transport:
-        transport = httpx.AsyncHTTPTransport(retries=3)
-
-    # Generate list of compatible python versions for shrinking down the list of
-    # dependencies. This is done to avoid implementing PEP 440 version specifier
-    # intersections on both left hand and right hand between `requires_python` and the
-    # markers
-    python_versions = []
-    for minor in range(MINIMUM_SUPPORTED_PYTHON_MINOR, 101):
-        version = Version(f"3.{minor}")
-        if all(version in i for i in requires_python):
-            python_versions.append(version)
-    if Version("4.0") in requires_python:
-        python_versions.append(Version("4.0"))
-
-    state = State(root_requirement, executor)
-
-    start = time.time()
-
+    client: httpx.AsyncClient,
+    download_wheels: bool,
+    maximum_versions: bool,
+    python_versions: list[Version],
+):
+    """Alternate between processing the queue and fetching the missing information
+    until everything is resolved"""
     while True:
         # We have packages for which we need to recompute the candidate
         while state.queue:
             # state.assert_normalization()
-            name = state.queue.pop(0)
-            await update_single_package(state, name, maximum_versions, python_versions)
+            _depth, _versions, name = heappop(state.queue)
+            state.queued.remove(name)
+            await update_single_package(
+                state, cache, name, maximum_versions, python_versions
+            )
 
         # Log the current set of candidates
         candidates_fmt = " ".join(
@@ -485,35 +698,119 @@ async def resolve_requirement(
         # This is the fastest to fetch metadata because we're just getting JSON
         # from a CDN
         if state.fetch_versions or state.fetch_metadata:
-            await fetch_versions_and_metadata(state, cache, transport)
+            await fetch_versions_and_metadata(state, cache, client)
 
-        # Compute candidates again first before we do the slow METADATA and sdist part,
-        # maybe we get better candidates already
+        # Compute candidates again first before we do the slow METADATA and sdist
+        # part, maybe we get better candidates already
         if state.queue:
-            # Make the resolution deterministic and easier to understand from the logs
-            state.queue.sort()
             continue
 
         if download_wheels:  # Allow to skip this step
-            await get_deps_for_versions(state, cache)
+            await get_deps_for_versions(state, cache, client)
 
         # We found some METADATA for missing requires_dist, we can resolve further
         # before building sdists
         if state.queue:
-            state.queue.sort()
             continue
 
         # Everything else is resolved, time for the slowest part:
         # Do we have sdist for which we don't know the metadata yet?
         sdists = await find_sdists_for_build(state, cache)
-        if sdists:
-            await build_sdists(state, cache, sdists, transport)
+        start_sdist_builds(state, cache, sdists, client)
+        if state.sdist_builds:
+            # Don't let one slow build block all the others
+            await finish_sdist_builds(state)
             continue
 
         # This is when we know we're done, everything is resolved and all metadata
         # is the best it can be
         break
 
+
+def make_client(transport: httpx.AsyncHTTPTransport | None = None) -> httpx.AsyncClient:
+    """One client for a whole resolution (or multiple), so connections are reused
+    across rounds"""
+    if not transport:
+        transport = httpx.AsyncHTTPTransport(retries=3)
+    # With many resolutions sharing the client, requests wait for a free connection
+    # longer than any single request takes. The pool then acts as the semaphore over
+    # all of them, so waiting for it must not time out
+    timeout = httpx.Timeout(10.0, connect=10.0, pool=None)
+    limits = httpx.Limits(
+        max_connections=100, max_keepalive_connections=64, keepalive_expiry=300
+    )
+    return httpx.AsyncClient(
+        http2=True, transport=transport, timeout=timeout, limits=limits
+    )
+
+
+# Part of the key of cached resolutions, bump when a resolver change alters results
+RESOLUTION_CACHE_VERSION = 2
+
+
+async def resolve_requirement(
+    root_requirement: Requirement,
+    requires_python: VersionSpecifiers,
+    cache: Cache,
+    download_wheels: bool = True,
+    maximum_versions: bool = True,
+    transport: httpx.AsyncHTTPTransport | None = None,
+    client: httpx.AsyncClient | None = None,
+    cache_resolution: bool = False,
+) -> Resolution:
+    """Resolves `root_requirement`. Pass a `client` to share its connection pool when
+    resolving multiple requirements, otherwise the resolution uses its own client with
+    `transport`.
+
+    With `cache_resolution`, a finished resolution is stored and returned for the same
+    inputs. It's tied to the cached version lists of the packages it contains, so it's
+    exactly as stale as those: new releases on the index are only picked up after
+    resolving with `refresh_versions` (which also skips reading the cached resolution).
+    Since we never check the index, it's opt-in"""
+
+    # Generate list of compatible python versions for shrinking down the list of
+    # dependencies. This is done to avoid implementing PEP 440 version specifier
+    # intersections on both left hand and right hand between `requires_python` and the
+    # markers
+    python_versions = []
+    for minor in range(MINIMUM_SUPPORTED_PYTHON_MINOR, 101):
+        version = Version(f"3.{minor}")
+        if all(version in i for i in requires_python):
+            python_versions.append(version)
+    if Version("4.0") in requires_python:
+        python_versions.append(Version("4.0"))
+
+    # Bump the format version when the resolver changes its results
+    resolution_key = (
+        f"{RESOLUTION_CACHE_VERSION} {root_requirement} {requires_python} "
+        f"{download_wheels} {maximum_versions}"
+    )
+    resolution_cache_name = sha256(resolution_key.encode()).hexdigest() + ".json"
+    if cache_resolution and not cache.refresh_versions:
+        if cached := cache.get("resolutions", resolution_cache_name):
+            # Only valid if no version list was refreshed since we resolved
+            cached_data = json.loads(cached)
+            names = [release["name"] for release in cached_data["package_data"]]
+            releases_digest = cached_releases_digest(cache, names)
+            if releases_digest and cached_data["releases_digest"] == releases_digest:
+                logger.info(f"Using cached resolution for {root_requirement}")
+                return Resolution.from_json(cached)
+            logger.info(f"Cached resolution for {root_requirement} is outdated")
+
+    state = State(root_requirement)
+
+    start = time.time()
+
+    if client:
+        await resolve_loop(
+            state, cache, client, download_wheels, maximum_versions, python_versions
+        )
+    else:
+        async with make_client(transport) as client:
+            await resolve_loop(
+                state, cache, client, download_wheels, maximum_versions, python_versions
+            )
+
     end = time.time()
     logger.info(f"resolution ours took {end - start:.3f}s")
 
@@ -526,7 +823,16 @@ async def resolve_requirement(
             extras=state.candidates[name][1],
         )
 
-    return Resolution([root_requirement], package_data)
+    resolution = Resolution([root_requirement], package_data)
+    if cache_resolution:
+        # Written after the resolution, so a refresh is already in the version lists
+        releases_digest = cached_releases_digest(
+            cache, [name for name, _version in package_data]
+        )
+        cache.set(
+            "resolutions", resolution_cache_name, resolution.to_json(releases_digest)
+        )
+    return resolution
 
 
 def freeze(resolution: Resolution, root_requirement: Requirement) -> str:
@@ -534,27 +840,49 @@ def freeze(resolution: Resolution, root_requirement: Requirement) -> str:
     resolutions_ours.mkdir(exist_ok=True)
     assert "/" not in str(root_requirement)
 
-    # We want to have a trailing newline
-    lines = [
-        f"{package_data.unnormalized_name}=={version}\n"
-        for (name, version), package_data in resolution.package_data.items()
-    ]
+    # Build both the txt and the toml in a single sorted pass
+    lines = []
+    toml_tables = []
+    for (name, version), package_data in sorted(resolution.package_data.items()):
+        # We want to have a trailing newline
+        lines.append(f"{package_data.unnormalized_name}=={version}\n")
+        toml_tables.append(
+            toml_table(
+                name, str(version), [str(req) for req in package_data.requirements]
+            )
+        )
+    freeze_txt = "".join(lines)
     resolutions_ours.joinpath(str(root_requirement)).with_suffix(".txt").write_text(
-        "".join(lines)
+        freeze_txt
     )
-    toml_data = {}
-    for (name, version), package_data in sorted(resolution.package_data.items()):
-        toml_data[name] = {
-            "version": str(version),
-            "requirements": [str(req) for req in package_data.requirements],
-        }
 
     pseudo_lock_file = resolutions_ours.joinpath(str(root_requirement)).with_suffix(
         ".toml"
     )
-    # much faster than tomlkit
-    pseudo_lock_file.write_text(tomli_w.dumps(toml_data))
-    return "".join(lines)
+    pseudo_lock_file.write_text("\n".join(toml_tables))
+    return freeze_txt
+
+
+def toml_table(name: NormalizedName, version: str, requirements: list[str]) -> str:
+    """A single package in the pseudo lock file, formatted like `tomli_w.dumps` did but
+    without going through the generic serializer. Normalized names are valid bare keys
+    and json strings (without ascii escaping) are valid toml strings"""
+    if requirements:
+        requirements_toml = (
+            "[\n"
+            + "".join(
+                f"    {json.dumps(requirement, ensure_ascii=False)},\n"
+                for requirement in requirements
+            )
+            + "]"
+        )
+    else:
+        requirements_toml = "[]"
+    return (
+        f"[{name}]\n"
+        f"version = {json.dumps(version)}\n"
+        f"requirements = {requirements_toml}\n"
+    )
 
 
 def main():
@@ -581,6 +909,7 @@ def main():
     if len(sys.argv) == 2:
         root_requirement = Requirement(sys.argv[1])
     start = time.time()
+    install_uvloop()
     resolution: Resolution = asyncio.run(
         resolve_requirement(
             root_requirement,
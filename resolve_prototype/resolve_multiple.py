@@ -3,14 +3,52 @@ benchmarking"""
 
 import asyncio
 import logging
+import statistics
+import time
 from argparse import ArgumentParser
 
-from httpx import AsyncHTTPTransport
-
 from pypi_types.pep440_rs import VersionSpecifiers
 from pypi_types.pep508_rs import Requirement
-from resolve_prototype.common import Cache, default_cache_dir
-from resolve_prototype.resolve import Resolution, resolve_requirement, freeze
+from resolve_prototype.common import Cache, default_cache_dir, install_uvloop
+from resolve_prototype.resolve import (
+    Resolution,
+    resolve_requirement,
+    freeze,
+    make_client,
+)
+
+
+async def resolve_all(
+    requirements: list[str],
+    requires_python: VersionSpecifiers,
+    iterations: int,
+    warmup: int,
+):
+    # A single event loop and client, so the connections stay warm between
+    # resolutions
+    root_requirements = [Requirement(requirement) for requirement in requirements]
+    timings: dict[str, list[float]] = {str(req): [] for req in root_requirements}
+    async with make_client() as client:
+        # The warmup runs fill the cache and aren't measured
+        for i in range(warmup + iterations):
+            for root_requirement in root_requirements:
+                start = time.perf_counter()
+                resolution: Resolution = await resolve_requirement(
+                    root_requirement,
+                    requires_python,
+                    Cache(default_cache_dir),
+                    client=client,
+                )
+                end = time.perf_counter()
+                if i >= warmup:
+                    timings[str(root_requirement)].append(end - start)
+                freeze(resolution, root_requirement)
+    for requirement, times in timings.items():
+        print(
+            f"{requirement}: mean {statistics.mean(times):.3f}s"
+            f" ± {statistics.pstdev(times):.3f}s,"
+            f" min {min(times):.3f}s, max {max(times):.3f}s ({len(times)} runs)"
+        )
 
 
 def main():
@@ -19,24 +57,15 @@ def main():
     requires_python = VersionSpecifiers(">=3.7,<3.12")
 
     parser = ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=1)
     parser.add_argument("requirement", nargs="+")
     args = parser.parse_args()
 
-    transport = AsyncHTTPTransport(retries=3)
-
-    for i in range(30):
-        print(i)
-        for requirement in args.requirement:
-            root_requirement = Requirement(requirement)
-            resolution: Resolution = asyncio.run(
-                resolve_requirement(
-                    root_requirement,
-                    requires_python,
-                    Cache(default_cache_dir),
-                    transport=transport,
-                )
-            )
-            freeze(resolution, root_requirement)
+    install_uvloop()
+    asyncio.run(
+        resolve_all(args.requirement, requires_python, args.iterations, args.warmup)
+    )
 
 
 if __name__ == "__main__":
@@ -1,26 +1,31 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-import functools
 import json
 import logging
+import os
 import sys
 import time
 from collections.abc import Iterable, Awaitable
+from itertools import islice
 from pathlib import Path
-from subprocess import check_output
+from subprocess import CalledProcessError
 from typing import Any
 
 from build import BuildBackendException
-from httpx import AsyncHTTPTransport, HTTPError
+from httpx import AsyncClient, HTTPError
 from tqdm import tqdm
 
 from pypi_types.pep440_rs import VersionSpecifiers
 from pypi_types.pep508_rs import Requirement
 from resolve_prototype import resolve_requirement, Cache, default_cache_dir
+from resolve_prototype.common import base_dir, install_uvloop, normalize
+from resolve_prototype.resolve import make_client
 
 logger = logging.getLogger(__name__)
 
-root = Path(check_output(["git", "rev-parse", "--show-toplevel"], text=True).strip())
+root = Path(os.environ.get("RESOLVE_ROOT") or base_dir)
+
+# Resolutions in flight at the same time, they all share one connection pool
+MAX_CONCURRENT_RESOLUTIONS = 50
 
 
 def as_completed_with_limit(
@@ -36,7 +41,8 @@ def as_completed_with_limit(
     return asyncio.as_completed(list(sem_coro(name, c) for (name, c) in coros))
 
 
-pending = []
+# All resolutions run in the same event loop, so this needs no lock
+pending: set[str] = set()
 
 
 async def single(
@@ -45,93 +51,90 @@ async def single(
     project: str,
     requires_python: VersionSpecifiers,
     top_packages: list,
-    transport: AsyncHTTPTransport,
+    client: AsyncClient,
+    cache: Cache,
 ):
-    logger.info(f"Resolving {idx + 1}/{len(top_packages)} {project}")
-    pending.append(project)
+    # Lazy formatting, this runs for every package even when info is disabled
+    logger.info("Resolving %s/%s %s", idx + 1, len(top_packages), project)
+    pending.add(project)
     try:
         start = time.time()
-        cache = Cache(default_cache_dir, refresh_versions=False)
         requirement = Requirement(project)
         resolution = await resolve_requirement(
             # TODO: Force latest version
             requirement,
             requires_python,
             cache,
-            transport=transport,
+            client=client,
         )
         end = time.time()
-        logging.info(f"{project} {end - start: .3f}s ({len(resolution.package_data)})")
+        logger.info("%s %.3fs (%s)", project, end - start, len(resolution.package_data))
         # logger.info(freeze(resolution, requirement))
-    except (RuntimeError, ValueError, HTTPError, BuildBackendException) as e:
+    except (
+        RuntimeError,
+        ValueError,
+        HTTPError,
+        BuildBackendException,
+        CalledProcessError,
+    ) as e:
         failures.append(project)
         tqdm.write(str(e))
-    pending.remove(project)
+    pending.discard(project)
 
 
-def single_sync(idx, project, failures, requires_python, top_packages):
-    transport = AsyncHTTPTransport(retries=3)
-    asyncio.run(
-        single(failures, idx, project, requires_python, top_packages, transport)
-    )
+async def refresh_description(bar: tqdm):
+    while True:
+        bar.set_description(", ".join(islice(pending, 5))[:40])
+        await asyncio.sleep(0.25)
 
 
-def main():
+async def main_async():
     pypi_top_json = root.joinpath("download").joinpath(
         "top-pypi-packages-30-days.min.json"
     )
-    top_packages = [i["project"] for i in json.loads(pypi_top_json.read_text())["rows"]]
-    top_packages = top_packages
+    # The same project can be listed under different spellings
+    top_packages = list(
+        {
+            normalize(i["project"]): i["project"]
+            for i in json.loads(pypi_top_json.read_text())["rows"]
+        }.values()
+    )
     if len(sys.argv) > 1:
         top_packages = top_packages[: int(sys.argv[1])]
     requires_python = VersionSpecifiers(">=3.8,<3.12")
-    # transport = AsyncHTTPTransport(retries=3)
     failures = []
-
-    with ThreadPoolExecutor() as executor:
-        bar = tqdm(
-            executor.map(
-                functools.partial(
-                    single_sync,
-                    failures=failures,
-                    requires_python=requires_python,
-                    top_packages=top_packages,
+    # The resolutions can't reuse each other's subgraphs since the constraints differ,
+    # but they share the releases, requirements and built sdists through the cache
+    cache = Cache(default_cache_dir, refresh_versions=False)
+
+    # All resolutions run in one event loop with one client, so connections to pypi
+    # are reused between packages
+    async with make_client() as client:
+        coros = [
+            (
+                project,
+                single(
+                    failures, idx, project, requires_python, top_packages, client, cache
                 ),
-                *zip(*list(enumerate(top_packages)), strict=True),
-            ),
-            total=len(top_packages),
-        )
-        for _ in bar:
-            bar.set_description(", ".join(pending)[:40])
-
-    # all_start = time.time()
-    # for idx, project in enumerate(tqdm(top_packages, file=sys.stdout)):
-    #    asyncio.run(
-    #        single(failures, idx, project, requires_python, top_packages, transport)
-    #    )
-    # batch_size = 100
-    # for batch_start in tqdm(
-    #    list(range(len(top_packages) // batch_size)), file=sys.stdout
-    # ):
-    #    await asyncio.gather(
-    #        *[
-    #            single(
-    #                failures,
-    #                batch_start + idx,
-    #                package,
-    #                requires_python,
-    #                top_packages,
-    #                transport,
-    #            )
-    #            for idx, package in enumerate(
-    #                top_packages[batch_start : batch_start + batch_size]
-    #            )
-    #        ]
-    #    )
-    # all_stop = time.time()
-    # print(f"{all_stop-all_start}s")
+            )
+            for idx, project in enumerate(top_packages)
+        ]
+        bar = tqdm(total=len(top_packages))
+        # Show what's running independent of completions, which only count
+        ticker = asyncio.create_task(refresh_description(bar))
+        for completed in as_completed_with_limit(MAX_CONCURRENT_RESOLUTIONS, coros):
+            await completed
+            bar.update(1)
+        ticker.cancel()
+        bar.close()
+
     print(f"{len(failures)}: {failures}")
 
 
+def main():
+    install_uvloop()
+    asyncio.run(main_async())
+
+
 if __name__ == "__main__":
     main()
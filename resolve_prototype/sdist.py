@@ -1,26 +1,38 @@
 import asyncio
+import atexit
+import io
 import logging
+import multiprocessing
 import os
+import pickle
 import shutil
+import tarfile
 import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from queue import SimpleQueue
 from subprocess import CalledProcessError, run
 from tempfile import TemporaryDirectory
 from typing import TYPE_CHECKING
+from zipfile import ZipFile
 
 import aiofiles
-from build import ProjectBuilder
-from httpx import AsyncClient, AsyncBaseTransport
+from build import BuildBackendException, ProjectBuilder
+from httpx import AsyncClient, HTTPError
 
 from pypi_types import pypi_releases, core_metadata
 from pypi_types.pep440_rs import Version
-from resolve_prototype.common import user_agent, Cache, NormalizedName, normalize
+from resolve_prototype.common import user_agent, Cache, NormalizedName
 
 if TYPE_CHECKING:
     from resolve_prototype.resolve import State
 
 logger = logging.getLogger(__name__)
 
+# The PEP 517 metadata builds run in their own processes, so their python side
+# bookkeeping doesn't hold up the event loop. Created on first use
+build_pool: ProcessPoolExecutor | None = None
+
 
 class ProjectHooksCaptureOutput:
     """Boilerplate to get stdout and stderr for the project-hooks subprocesses"""
@@ -43,43 +55,163 @@ class ProjectHooksCaptureOutput:
         result.check_returncode()
 
 
-async def to_thread(func, /, *args, **kwargs):
-    """Backport from python 3.9
-    https://github.com/python/cpython/blob/f4c03484da59049eb62a9bf7777b963e2267d187/Lib/asyncio/threads.py
+def build_metadata(
+    src_dir: Path, metadata_dir: Path
+) -> tuple[Exception | None, str, str]:
+    """Runs in the `build_pool`, returns (error, stdout, stderr). The error is
+    returned instead of raised so it comes back with the captured output"""
+    capture = ProjectHooksCaptureOutput()
+    try:
+        ProjectBuilder(src_dir, runner=capture.subprocess_runner).metadata_path(
+            metadata_dir
+        )
+    except (CalledProcessError, BuildBackendException) as e:
+        # `BuildBackendException` doesn't pass its arguments to `Exception`, so it
+        # can't be unpickled without setting them
+        if isinstance(e, BuildBackendException):
+            e.args = (e.exception, str(e))
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            # The backend error wrapped in the `BuildBackendException` may not survive
+            return RuntimeError(str(e)), capture.stdout, capture.stderr
+        return e, capture.stdout, capture.stderr
+    return None, capture.stdout, capture.stderr
+
+
+def get_build_pool() -> ProcessPoolExecutor:
+    global build_pool
+    if not build_pool:
+        # Forking a process with a running event loop and threads is fragile
+        build_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+        )
+        # Covers all entrypoints, including the scripts and the tests
+        atexit.register(build_pool.shutdown)
+    return build_pool
+
+
+class ChunkStream(io.RawIOBase):
+    """Blocking reader over the chunks of a download, so tarfile can extract in a
+    thread while the event loop is still downloading. `None` marks the end"""
+
+    def __init__(self):
+        self.chunks: SimpleQueue[bytes | None] = SimpleQueue()
+        self.buffer = b""
+        self.finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.buffer:
+            if self.finished:
+                return 0
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.finished = True
+            else:
+                self.buffer = chunk
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
 
-    Asynchronously run function *func* in a separate thread.
-    Any *args and **kwargs supplied for this function are directly passed
-    to *func*. Also, the current :class:`contextvars.Context` is propagated,
-    allowing context variables from the main thread to be accessed in the
-    separate thread.
-    Return a coroutine that can be awaited to get the eventual result of *func*.
-    """
 
-    import functools
-    import contextvars
+def needed_for_build(name: str) -> bool:
+    """Bytecode is never needed for building. Backends may read anything else (e.g.
+    `setup.py` reading the readme from docs or setuptools discovering test packages),
+    so we can't skip tests or docs without changing the metadata"""
+    return "__pycache__/" not in name and not name.endswith((".pyc", ".pyo"))
 
-    from asyncio import events
 
-    loop = events.get_running_loop()
-    ctx = contextvars.copy_context()
-    func_call = functools.partial(ctx.run, func, *args, **kwargs)
-    return await loop.run_in_executor(None, func_call)
+def extract_tar_stream(stream: ChunkStream, extracted: Path):
+    with tarfile.open(fileobj=io.BufferedReader(stream), mode="r|*") as tar:
+        # A generator, since in stream mode we can only go over the members once
+        tar.extractall(
+            extracted,
+            members=(member for member in tar if needed_for_build(member.name)),
+        )
+
+
+def extract_zip(downloaded_file: Path, extracted: Path):
+    with ZipFile(downloaded_file) as zip_file:
+        zip_file.extractall(
+            extracted, members=filter(needed_for_build, zip_file.namelist())
+        )
+
+
+async def download_and_extract(
+    client: AsyncClient, file: pypi_releases.File, tempdir: str, extracted: Path
+):
+    """Tarballs are extracted while downloading, other archives (zip) need to be
+    written to disk first"""
+    if file.filename.endswith((".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar")):
+        stream = ChunkStream()
+
+        async def download():
+            try:
+                async with client.stream(
+                    "GET", file.url, headers={"user-agent": user_agent}
+                ) as response:
+                    async for chunk in response.aiter_bytes():
+                        stream.chunks.put(chunk)
+            finally:
+                # Also unblock the extraction if the download failed
+                stream.chunks.put(None)
+
+        await asyncio.gather(
+            download(), asyncio.to_thread(extract_tar_stream, stream, extracted)
+        )
+        return
+
+    downloaded_file = Path(tempdir).joinpath(file.filename)
+    async with (
+        aiofiles.open(downloaded_file, mode="wb") as f,
+        client.stream("GET", file.url, headers={"user-agent": user_agent}) as response,
+    ):
+        async for chunk in response.aiter_bytes():
+            await f.write(chunk)
+    if file.filename.endswith(".zip"):
+        await asyncio.to_thread(extract_zip, downloaded_file, extracted)
+    else:
+        await asyncio.to_thread(shutil.unpack_archive, downloaded_file, extracted)
 
 
 async def build_sdist(
     client: AsyncClient, file: pypi_releases.File, cache: Cache
 ) -> core_metadata.Metadata21:
-    # TODO(konstin): Better cache key, outside of pypi this will cause cache collision
-    if metadata_path := cache.get_path(
-        "sdist_build_metadata", file.filename + ".METADATA"
-    ):
+    # Keyed by content, so the same sdist from another index or under another filename
+    # doesn't get built again, while different files with the same name don't collide
+    cache_key = file.hashes.sha256 + ".METADATA"
+    if metadata_path := cache.get_path("sdist_build_metadata", cache_key):
         if metadata_path.is_file():
             logger.debug(f"Using cached json metadata for {file.filename}")
             metadata = core_metadata.Metadata21.read(str(metadata_path), file.filename)
             logger.debug(f"sdist {file.filename} {metadata.requires_dist}")
             return metadata
 
-    with TemporaryDirectory() as tempdir:
+    # PEP 658: If the index serves the metadata of the sdist, we don't need to build it
+    if file.has_metadata_file():
+        url = file.url + ".metadata"
+        logger.debug(f"Querying {url}")
+        try:
+            response = await client.get(url, headers={"user-agent": user_agent})
+            response.raise_for_status()
+        except HTTPError as err:
+            # The index advertised the file, but it's missing or the request failed
+            logger.warning(f"Failed to fetch {url}, building instead: {err}")
+        else:
+            if requires_dist_is_static(response.content):
+                metadata = core_metadata.Metadata21.from_bytes(
+                    response.content, file.filename
+                )
+                cache.set("sdist_build_metadata", cache_key, response.text)
+                logger.debug(f"sdist {file.filename} {metadata.requires_dist}")
+                return metadata
+            logger.debug(f"Dynamic requirements in {url}, building instead")
+
+    with TemporaryDirectory(dir=cache.tmp_root) as tempdir:
         metadata_path = await build_sdist_impl(client, file, tempdir)
 
         try:
@@ -89,31 +221,38 @@ async def build_sdist(
                 f"Failed to parse sdist built metadata for {file.filename}, "
                 "this is most likely a bug"
             ) from e
-        cache.set(
-            "sdist_build_metadata",
-            file.filename + ".METADATA",
-            metadata_path.read_text(),
-        )
+        cache.set("sdist_build_metadata", cache_key, metadata_path.read_text())
     logger.debug(f"sdist {file.filename} {metadata.requires_dist}")
     return metadata
 
 
+def requires_dist_is_static(metadata: bytes) -> bool:
+    """Only from metadata 2.2 on (PEP 643) the requirements in an sdist's PKG-INFO
+    are the ones the built wheel will have, unless they're marked dynamic"""
+    headers = metadata.split(b"\n\n", 1)[0].decode(errors="replace").splitlines()
+    metadata_version = None
+    for line in headers:
+        key, _, value = line.partition(":")
+        key, value = key.strip().lower(), value.strip().lower()
+        if key == "metadata-version":
+            try:
+                metadata_version = tuple(int(part) for part in value.split("."))
+            except ValueError:
+                return False
+        elif key == "dynamic" and value == "requires-dist":
+            return False
+    return metadata_version is not None and metadata_version >= (2, 2)
+
+
 async def build_sdist_impl(
     client: AsyncClient, file: pypi_releases.File, tempdir: str
 ) -> Path:
-    logger.info(f"Downloading {file.filename}")
-    downloaded_file = Path(tempdir).joinpath(file.filename)
+    logger.info(f"Downloading and extracting {file.filename}")
     start = time.time()
-    async with (
-        aiofiles.open(downloaded_file, mode="wb") as f,
-        client.stream("GET", file.url, headers={"user-agent": user_agent}) as response,
-    ):
-        async for chunk in response.aiter_bytes():
-            await f.write(chunk)
-    end = time.time()
-    logger.info(f"Downloading {file.filename} took {end - start:.2f}s, extracting")
     extracted = Path(tempdir).joinpath("extracted")
-    await to_thread(shutil.unpack_archive, downloaded_file, extracted)
+    await download_and_extract(client, file, tempdir, extracted)
+    end = time.time()
+    logger.info(f"Downloading and extracting {file.filename} took {end - start:.2f}s")
     try:
         [src_dir] = list(extracted.iterdir())
     except ValueError:
@@ -121,25 +260,22 @@ async def build_sdist_impl(
         raise
     logger.info(f"Building {file.filename}")
     metadata_dir = Path(tempdir).joinpath("metadata")
-    capture = ProjectHooksCaptureOutput()
     start = time.time()
-    try:
-        await to_thread(
-            lambda: ProjectBuilder(
-                src_dir, runner=capture.subprocess_runner
-            ).metadata_path(metadata_dir)
-        )
-    except CalledProcessError as e:
-        raise RuntimeError(
-            f"Failed to build metadata for {file.filename}: {e}\n"
-            f"--- Stdout:\n{capture.stdout}\n"
-            f"--- Stderr:\n{capture.stderr}\n"
+    error, stdout, stderr = await asyncio.get_running_loop().run_in_executor(
+        get_build_pool(), build_metadata, src_dir, metadata_dir
+    )
+    if error:
+        error.add_note(
+            f"Failed to build metadata for {file.filename}\n"
+            f"--- Stdout:\n{stdout}\n"
+            f"--- Stderr:\n{stderr}\n"
             "---\n"
-        ) from None
-    if capture.stderr:
+        )
+        raise error
+    if stderr:
         logger.warning(
             f"Messages from building {file.filename}:\n---"
-            f" stderr:\n{capture.stderr.strip()}\n---\n"
+            f" stderr:\n{stderr.strip()}\n---\n"
         )
     end = time.time()
     logger.info(f"Building {file.filename} took {end - start:.2f}")
@@ -149,33 +285,47 @@ async def build_sdist_impl(
     return dist_info.joinpath("METADATA")
 
 
-async def build_sdists(
+def start_sdist_builds(
     state: "State",
     cache: Cache,
     sdists: list[tuple[NormalizedName, Version, pypi_releases.File]],
-    transport: AsyncBaseTransport,
+    client: AsyncClient,
 ):
-    # Download and PEP 517 query sdists for metadata
+    """Download and PEP 517 query sdists for metadata in the background, so the
+    resolution can continue as soon as any of them is done"""
+    if not sdists:
+        return
     logger.info(
         f"Building {[f'{name} {version}' for (name, version, _filename) in sdists]}"
     )
-    async with AsyncClient(http2=True, transport=transport) as client:
-        metadatas = await asyncio.gather(
-            *[build_sdist(client, sdist[2], cache) for sdist in sdists]
-        )
-    for (name, version, _filename), metadata in sorted(
-        zip(sdists, metadatas, strict=True)
-    ):
+
+    async def bounded(file: pypi_releases.File) -> core_metadata.Metadata21:
+        async with state.sdist_semaphore:
+            return await build_sdist(client, file, cache)
+
+    for name, version, file in sdists:
+        state.sdist_builds[(name, version)] = asyncio.create_task(bounded(file))
+
+
+async def finish_sdist_builds(state: "State"):
+    """Wait until at least one sdist build is done and add its requirements"""
+    done, _pending = await asyncio.wait(
+        state.sdist_builds.values(), return_when=asyncio.FIRST_COMPLETED
+    )
+    for (name, version), task in sorted(state.sdist_builds.items()):
+        if task not in done:
+            continue
+        del state.sdist_builds[(name, version)]
+        metadata = task.result()
         state.requirements[(name, version)] = metadata.requires_dist
         state.requirements_credible.add((name, version))
-        state.changed_metadata[(name, version)] = state.requirements[(name, version)]
         state.resolved_sdists.add((name, version))
-        if name not in state.queue:
-            state.queue.append(name)
+        state.enqueue(name)
+        # While we were building, the resolution went on and might have picked another
+        # version. Then we only keep the requirements for when we pick it again
+        if state.candidates.get(name, (None, None))[0] != version:
+            continue
+        state.changed_metadata[(name, version)] = state.requirements[(name, version)]
 
         for added in sorted(metadata.requires_dist, key=str):
-            state.requirements_per_package[normalize(added.name)].add(
-                (added, (name, version))
-            )
-            if normalize(added.name) not in state.queue:
-                state.queue.append(normalize(added.name))
+            state.enqueue(state.add_requirement(added, (name, version)))
@@ -1,9 +1,14 @@
+import io
 import os
-from concurrent.futures import Executor
+import re
+import shutil
+import tarfile
+from collections.abc import Callable
+from heapq import heappop
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any
 from unittest.mock import patch
+from zipfile import ZipFile, ZIP_STORED
 
 import httpx
 import orjson
@@ -12,18 +17,46 @@ import requests
 import respx
 from httpx import Response, AsyncClient
 from respx import MockRouter
-from zstandard import decompress, compress
+from zstandard import ZstdCompressor, ZstdDecompressor
 
-from pypi_types import pypi_releases, filename_to_version, core_metadata
-from pypi_types.pep440_rs import VersionSpecifiers
+from pypi_types import pypi_releases, filename_to_version, core_metadata, pick_version
+from pypi_types.pep440_rs import Version, VersionSpecifiers
 from pypi_types.pep508_rs import Requirement
 from resolve_prototype.common import Cache, default_cache_dir
-from resolve_prototype.resolve import resolve_requirement, Resolution
-from resolve_prototype.metadata import parse_requirement_fixup
+from resolve_prototype.resolve import (
+    resolve_requirement,
+    Resolution,
+    State,
+    update_single_package,
+)
+from resolve_prototype.sdist import build_sdist, requires_dist_is_static
+from resolve_prototype.metadata import (
+    add_credible_requirements,
+    parse_requirement_fixup,
+    parse_requirements_fixup,
+)
+from resolve_prototype.package_index import (
+    MissingRange,
+    PrefetchedZipFile,
+    WHEEL_TAIL_SIZE,
+    get_metadata_from_sidecar,
+    get_metadata_from_wheel,
+)
 
 update_snapshots = os.environ.get("UPDATE_SNAPSHOTS")
+# Compiled once instead of for each test. Names and versions are ascii
+simple_url = re.compile(
+    r"https://pypi\.org/simple/(?P<name>[\w-]+)/"
+    r"\?format=application/vnd\.pypi\.simple\.v1\+json",
+    re.ASCII,
+)
+json_metadata_url = re.compile(
+    r"https://pypi\.org/pypi/(?P<name>[\w-]+)/(?P<version>[\w.-]+)/json", re.ASCII
+)
 assert_all_mocked = not update_snapshots
 assert_all_called = not update_snapshots
+# Shared by the resolution tests, the snapshots are for this range
+requires_python = VersionSpecifiers(">= 3.8")
 
 
 class TrimmedMetadataCache(Cache):
@@ -33,30 +66,10 @@ class TrimmedMetadataCache(Cache):
         if bucket == "wheel_metadata":
             # crudely remove the Description which is a lot of data we don't need in
             # the repo
-            content = content.split("\n\n")[0]
+            content = content.partition("\n\n")[0]
             return super().set(bucket, name, content)
 
 
-class DummyExecutor(Executor):
-    """https://stackoverflow.com/a/60109361/3549270"""
-
-    def __init__(self, **kwargs):
-        pass
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, exc_traceback):
-        pass
-
-    # noinspection PyArgumentList
-    def submit(self, fn, *args, **kwargs):
-        return fn(*args, **kwargs)
-
-    def shutdown(self, wait=True, **kwargs):
-        pass
-
-
 def test_handle_filename():
     assert filename_to_version("jedi", "jedi-0.8.0-final0.tar.gz") == "0.8.0-final0"
     assert filename_to_version("typed-ast", "typed-ast-0.5.1.tar.gz") == "0.5.1"
@@ -78,6 +91,287 @@ def test_parse_requirement_fixup(caplog):
     assert wrong.version_or_url == correct.version_or_url
 
 
+def test_pick_version():
+    versions = [Version(version) for version in ["1.0", "1.1", "2.0a1", "2.0", "3.0b1"]]
+    specifiers = list(VersionSpecifiers(">=1.1,<3"))
+    assert pick_version(versions, specifiers, True, set()) == Version("2.0")
+    assert pick_version(versions, specifiers, False, set()) == Version("1.1")
+    assert pick_version(versions, specifiers, False, {(2, 0)}) == Version("1.1")
+    assert (
+        pick_version(versions, list(VersionSpecifiers(">=3.0b1")), True, set()) is None
+    )
+    assert pick_version(
+        versions, list(VersionSpecifiers(">=3.0b1")), True, {(3, 0)}
+    ) == Version("3.0b1")
+
+
+def test_parse_requirements_fixup(caplog):
+    requirements = ["numpy", "elasticsearch-dsl (>=7.2.0,<8.0.0)"]
+    parsed = parse_requirements_fixup(requirements, "django-elasticsearch-dsl 7.2.2")
+    assert parsed == [Requirement(requirement) for requirement in requirements]
+    assert caplog.messages == []
+    # One invalid requirement falls back to the fixup for each requirement
+    parsed = parse_requirements_fixup(
+        ["numpy", "elasticsearch-dsl (>=7.2.0<8.0.0)"], "django-elasticsearch-dsl 7.2.2"
+    )
+    assert parsed == [Requirement(requirement) for requirement in requirements]
+    assert caplog.messages == [
+        "Requirement `elasticsearch-dsl (>=7.2.0<8.0.0)` for django-elasticsearch-dsl"
+        " 7.2.2 is invalid (missing comma)"
+    ]
+
+
+@pytest.mark.asyncio()
+async def test_add_credible_requirements(tmp_path: Path):
+    """The wheel METADATA drops a requirement from the pypi json api and adds one
+    that's only active with an extra"""
+    state = State(Requirement("foo"))
+    cache = Cache(tmp_path)
+    python_versions = [Version("3.8")]
+    foo = ("foo", Version("1.0"))
+    for name in ["foo", "bar", "baz", "qux"]:
+        state.versions_cache_new[name] = [Version("1.0")]
+        state.requirements[(name, Version("1.0"))] = []
+    state.requirements[foo] = [Requirement("bar"), Requirement("baz")]
+
+    async def process_queue():
+        while state.queue:
+            _depth, _versions, name = heappop(state.queue)
+            state.queued.remove(name)
+            await update_single_package(state, cache, name, True, python_versions)
+
+    await process_queue()
+    assert set(state.candidates) == {"foo", "bar", "baz"}
+
+    wheel_requirements = [Requirement("bar"), Requirement('qux; extra == "test"')]
+    add_credible_requirements(state, *foo, wheel_requirements)
+    await process_queue()
+    assert state.requirements[foo] == wheel_requirements
+    assert state.requirements_per_package["bar"] == {(Requirement("bar"), foo)}
+    assert not state.requirements_per_package.get("baz")
+    assert not state.requirements_per_package.get("qux")
+    assert not state.changed_metadata
+
+
+wheel_metadata = b"""Metadata-Version: 2.1
+Name: foo
+Version: 1.0
+Requires-Dist: bar>=1
+
+"""
+
+
+def make_wheel() -> bytes:
+    """A wheel where the METADATA is too far from the end for the first request, and
+    not at the start either so a range at the wrong offset breaks it"""
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", ZIP_STORED) as wheel:
+        wheel.writestr("foo/__init__.py", b"# " * 1000)
+        wheel.writestr("foo-1.0.dist-info/METADATA", wheel_metadata)
+        wheel.writestr("foo/data.bin", os.urandom(2 * WHEEL_TAIL_SIZE))
+    return buffer.getvalue()
+
+
+def test_prefetched_zip_file():
+    data = make_wheel()
+    zip_file = PrefetchedZipFile(len(data))
+    zip_file.add(len(data) - 10, data[-10:])
+    zip_file.add(0, data[:10])
+    zip_file.add(20, data[20:30])
+    assert [start for start, _data in zip_file.chunks] == [0, 20, len(data) - 10]
+    # Adjacent and overlapping ranges are merged
+    zip_file.add(5, data[5:20])
+    assert zip_file.chunks == [(0, data[:30]), (len(data) - 10, data[-10:])]
+
+    assert zip_file.seek(-4, 2) == len(data) - 4
+    assert zip_file.read() == data[-4:]
+    assert zip_file.seek(2) == 2
+    assert zip_file.seek(3, 1) == 5
+    assert zip_file.tell() == 5
+    assert zip_file.read(10) == data[5:15]
+    assert zip_file.tell() == 15
+    with pytest.raises(MissingRange):
+        zip_file.read(20)
+
+
+wheel_url = "https://files.pythonhosted.org/packages/foo-1.0-py3-none-any.whl"
+
+
+def range_server(
+    data: bytes, honor_retry_range: bool = True
+) -> Callable[[httpx.Request], Response]:
+    """Serves the range requests for a wheel. Some servers ignore the range for the
+    retry and send the whole file"""
+
+    def serve_range(request: httpx.Request) -> Response:
+        first, _, last = request.headers["range"].removeprefix("bytes=").partition("-")
+        if first and not honor_retry_range:
+            return Response(200, content=data)
+        start = int(first) if first else len(data) - int(last)
+        end = int(last) + 1 if first else len(data)
+        return Response(
+            206,
+            content=data[start:end],
+            headers={"content-range": f"bytes {start}-{end - 1}/{len(data)}"},
+        )
+
+    return serve_range
+
+
+@pytest.mark.asyncio()
+@pytest.mark.parametrize("honor_retry_range", [True, False])
+@respx.mock(assert_all_mocked=True, assert_all_called=True)
+async def test_get_metadata_from_wheel(tmp_path: Path, honor_retry_range: bool):
+    """The first request only gets the tail, so we need the `MissingRange` retry"""
+    route = respx.get(wheel_url).mock(
+        side_effect=range_server(make_wheel(), honor_retry_range)
+    )
+    metadata = await get_metadata_from_wheel(
+        AsyncClient(),
+        "foo",
+        Version("1.0"),
+        "foo-1.0-py3-none-any.whl",
+        wheel_url,
+        Cache(tmp_path),
+    )
+    assert metadata.requires_dist == [Requirement("bar>=1")]
+    assert route.call_count == 2
+
+
+@pytest.mark.asyncio()
+@pytest.mark.parametrize("sidecar_status", [200, 404])
+@respx.mock(assert_all_mocked=True, assert_all_called=False)
+async def test_get_metadata_from_sidecar(tmp_path: Path, sidecar_status: int):
+    """If the PEP 658 METADATA is missing, we fall back to reading the wheel"""
+    [file] = pypi_releases.File.vec_from_json(
+        orjson.dumps(
+            [
+                {
+                    "filename": "foo-1.0-py3-none-any.whl",
+                    "hashes": {"sha256": "0" * 64},
+                    "url": wheel_url,
+                    "yanked": False,
+                    "data-dist-info-metadata": True,
+                }
+            ]
+        )
+    )
+    respx.get(wheel_url + ".metadata").mock(
+        return_value=Response(sidecar_status, content=wheel_metadata)
+    )
+    wheel_route = respx.get(wheel_url).mock(side_effect=range_server(make_wheel()))
+    metadata = await get_metadata_from_sidecar(
+        AsyncClient(), "foo", Version("1.0"), file, Cache(tmp_path)
+    )
+    assert metadata.requires_dist == [Requirement("bar>=1")]
+    assert wheel_route.called == (sidecar_status == 404)
+
+
+def test_requires_dist_is_static():
+    assert requires_dist_is_static(b"Metadata-Version: 2.2\nName: foo\n\nBody")
+    assert not requires_dist_is_static(b"Metadata-Version: 2.1\nName: foo\n")
+    assert not requires_dist_is_static(
+        b"Metadata-Version: 2.3\nName: foo\nDynamic: Requires-Dist\n"
+    )
+    # Only the headers count, not the description
+    assert requires_dist_is_static(
+        b"Metadata-Version: 2.2\nName: foo\n\nDynamic: Requires-Dist\n"
+    )
+    assert not requires_dist_is_static(b"Metadata-Version: two\n")
+
+
+# An in-tree PEP 517 backend, so building the sdist needs neither setuptools nor the
+# network
+sdist_backend = b"""from pathlib import Path
+
+
+def prepare_metadata_for_build_wheel(metadata_directory, config_settings=None):
+    dist_info = Path(metadata_directory).joinpath("foo-1.0.dist-info")
+    dist_info.mkdir()
+    dist_info.joinpath("METADATA").write_bytes(
+        b"Metadata-Version: 2.1\\nName: foo\\nVersion: 1.0\\nRequires-Dist: bar>=1\\n"
+    )
+    return dist_info.name
+"""
+
+
+def make_sdist() -> bytes:
+    files = {
+        "foo-1.0/pyproject.toml": b"[build-system]\n"
+        b"requires = []\n"
+        b'build-backend = "backend"\n'
+        b'backend-path = ["."]\n',
+        "foo-1.0/backend.py": sdist_backend,
+    }
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+@pytest.mark.asyncio()
+@pytest.mark.parametrize("metadata_status", [200, 404])
+@respx.mock(assert_all_mocked=True, assert_all_called=False)
+async def test_build_sdist_metadata_file(tmp_path: Path, metadata_status: int):
+    """With static requirements in the PEP 658 (here under the PEP 714 name) METADATA,
+    we don't download or build the sdist. If the file is missing, we build it"""
+    url = "https://files.pythonhosted.org/packages/foo-1.0.tar.gz"
+    [file] = pypi_releases.File.vec_from_json(
+        orjson.dumps(
+            [
+                {
+                    "filename": "foo-1.0.tar.gz",
+                    "hashes": {"sha256": "0" * 64},
+                    "url": url,
+                    "yanked": False,
+                    "core-metadata": {"sha256": "1" * 64},
+                }
+            ]
+        )
+    )
+    assert file.has_metadata_file()
+    metadata_file = wheel_metadata.replace(b"2.1", b"2.2")
+    respx.get(url + ".metadata").mock(
+        return_value=Response(metadata_status, content=metadata_file)
+    )
+    sdist_route = respx.get(url).mock(return_value=Response(200, content=make_sdist()))
+    metadata = await build_sdist(AsyncClient(), file, Cache(tmp_path))
+    assert metadata.requires_dist == [Requirement("bar>=1")]
+    assert sdist_route.called == (metadata_status == 404)
+
+
+# Reused instead of setting up a new context for each snapshot. Level 3 (zstd's
+# default) is much faster to write than higher levels and barely larger for json. The
+# `simple` snapshot is rewritten after every new project, so this matters
+compressor = ZstdCompressor(level=int(os.environ.get("ZSTD_LEVEL", 3)), threads=-1)
+decompressor = ZstdDecompressor()
+# Decompressed snapshot files, so each file is only read and decompressed once per
+# session
+snapshots: dict[Path, bytes] = {}
+
+
+def load_snapshot(path: Path) -> bytes:
+    if path not in snapshots:
+        # Streaming, so we don't hold the compressed file in memory next to the json
+        with (
+            path.open("rb", buffering=128 * 1024) as file,
+            decompressor.stream_reader(file) as reader,
+        ):
+            snapshots[path] = reader.readall()
+    return snapshots[path]
+
+
+def write_snapshot(path: Path, data: bytes):
+    with (
+        path.open("wb", buffering=128 * 1024) as file,
+        compressor.stream_writer(file) as writer,
+    ):
+        writer.write(data)
+
+
 def httpx_mock_impl(path: Path, request: httpx.Request) -> httpx.Response:
     if update_snapshots and not path.is_file():
         # Passthrough case
@@ -87,85 +381,94 @@ def httpx_mock_impl(path: Path, request: httpx.Request) -> httpx.Response:
         # Remove a larger chunk of the data
         del data["info"]["description"]
         path.parent.mkdir(parents=True, exist_ok=True)
-        path.with_suffix(".json.zst").write_bytes(
-            compress(orjson.dumps(data), level=10)
-        )
+        write_snapshot(path.with_suffix(".json.zst"), orjson.dumps(data))
 
     if path:
         # A json roundtrip here is measurably slower
-        uncompressed = decompress(path.with_suffix(".json.zst").read_bytes())
-        return Response(200, content=uncompressed)
+        return Response(200, content=load_snapshot(path.with_suffix(".json.zst")))
     else:
         raise FileNotFoundError(f"No mock at {path}")
 
 
-def httpx_mock_cache_impl(
-    data_dir: Path,
-    request: httpx.Request,
-    name: str,
-    cache: dict[str, Any],
-    file_stem: str,
-) -> httpx.Response:
-    path = data_dir.joinpath(file_stem).with_suffix(".json.zst")
+json_headers = {"content-type": "application/json"}
 
-    if not path.is_file() and update_snapshots:
-        path.write_bytes(compress(orjson.dumps({}), level=10))
 
+def httpx_mock_cache_impl(
+    path: Path, request: httpx.Request, name: str, cache: dict[str, bytes]
+) -> httpx.Response:
+    """`cache` holds the serialized responses, so we don't serialize them again on
+    each request"""
     if not cache:
-        cache.update(orjson.loads(decompress(path.read_bytes())))
+        try:
+            snapshot = load_snapshot(path)
+        except FileNotFoundError:
+            if not update_snapshots:
+                raise
+            write_snapshot(path, b"{}")
+            snapshot = b"{}"
+        cache.update(
+            (key, orjson.dumps(value)) for key, value in orjson.loads(snapshot).items()
+        )
 
+    # httpx binds each response to its request and consumes its stream, so we can't
+    # hand out the same response twice, only the serialized body
     if saved := cache.get(name):
-        return Response(200, json=saved)
+        return Response(200, content=saved, headers=json_headers)
     elif update_snapshots:
         # Passthrough case
         response = requests.get(request.url, headers=request.headers)
         response.raise_for_status()
-        saved = response.json()
+        saved = orjson.dumps(response.json())
         cache[name] = saved
-        path.write_bytes(compress(orjson.dumps(cache), level=10))
-        return Response(200, json=saved)
+        # Join the serialized entries instead of parsing them again
+        write_snapshot(
+            path,
+            b"{"
+            + b",".join(
+                orjson.dumps(key) + b":" + value for key, value in cache.items()
+            )
+            + b"}",
+        )
+        return Response(200, content=saved, headers=json_headers)
     else:
         raise FileNotFoundError(f"Missing mock for {name} at {path}")
 
 
 class HttpMock:
-    cache_simple: dict[str, Any]
-    cache_json_metadata: dict[str, Any]
+    cache_simple: dict[str, bytes]
+    cache_json_metadata: dict[str, bytes]
     data_dir: Path
+    simple_path: Path
+    json_metadata_path: Path
 
     def __init__(self, rootpath: Path, test_name: str):
         self.cache_simple = {}
         self.cache_json_metadata = {}
 
-        self.data_dir = rootpath.joinpath("test-data").joinpath(test_name)
-        self.data_dir.mkdir(exist_ok=True)
+        self.data_dir = rootpath.joinpath("test-data", test_name)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.simple_path = self.data_dir.joinpath("simple.json.zst")
+        self.json_metadata_path = self.data_dir.joinpath("json_metadata.json.zst")
 
     def httpx_mock_simple(self, request: httpx.Request, name: str) -> httpx.Response:
         # This should probably be a fixture or class instead
-        return httpx_mock_cache_impl(
-            self.data_dir, request, name, self.cache_simple, "simple"
-        )
+        return httpx_mock_cache_impl(self.simple_path, request, name, self.cache_simple)
 
     def httpx_mock_json_metadata(
         self, request: httpx.Request, name: str, version: str
     ) -> httpx.Response:
         # This should probably be a fixture or class instead
         return httpx_mock_cache_impl(
-            self.data_dir,
+            self.json_metadata_path,
             request,
             f"{name} {version}",
             self.cache_json_metadata,
-            "json_metadata",
         )
 
     def add_mocks(self, respx_mock: MockRouter):
-        route = respx_mock.route(
-            url__regex=r"https://pypi.org/simple/(?P<name>[\w\d_-]+)/\?format=application/vnd.pypi.simple.v1\+json"
-        )
+        route = respx_mock.route(url__regex=simple_url)
         route.side_effect = self.httpx_mock_simple
-        route = respx_mock.route(
-            url__regex=r"https://pypi.org/pypi/(?P<name>[\w\d_-]+)/(?P<version>[\w\d_.-]+)/json"
-        )
+        route = respx_mock.route(url__regex=json_metadata_url)
         if update_snapshots:
             respx_mock.route(host="files.pythonhosted.org").pass_through()
         route.side_effect = self.httpx_mock_json_metadata
@@ -180,16 +483,13 @@ class SdistMetadataMock:
     def __init__(self, test_name: str, rootpath: Path) -> None:
         self.test_name = test_name
         self.rootpath = rootpath
-        self.datafile = (
-            rootpath.joinpath("test-data")
-            .joinpath(test_name)
-            .joinpath("sdist_metadata")
-            .with_suffix(".json.zst")
+        self.datafile = rootpath.joinpath(
+            "test-data", test_name, "sdist_metadata.json.zst"
         )
         if update_snapshots and not self.datafile.is_file():
             self.data = {}
         else:
-            self.data = orjson.loads(decompress(self.datafile.read_bytes()))
+            self.data = orjson.loads(load_snapshot(self.datafile))
 
     async def mock_build_sdist(
         self, client: AsyncClient, file: pypi_releases.File, _cache: Cache
@@ -203,7 +503,7 @@ class SdistMetadataMock:
                     str(metadata_path), file.filename
                 )
                 self.data[file.filename] = metadata_path.read_text()
-            self.datafile.write_bytes(compress(orjson.dumps(self.data), level=10))
+            write_snapshot(self.datafile, orjson.dumps(self.data))
             return metadata
 
         if capture := self.data.get(file.filename):
@@ -212,13 +512,55 @@ class SdistMetadataMock:
             raise RuntimeError(f"Missing sdist metadata snapshot for {file.filename}")
 
 
+@pytest.fixture(scope="session")
+def http_mock_factory(pytestconfig: pytest.Config) -> Callable[[str], HttpMock]:
+    """Reuse the parsed snapshots of a test within the session"""
+    http_mocks: dict[str, HttpMock] = {}
+
+    def make(test_name: str) -> HttpMock:
+        if test_name not in http_mocks:
+            http_mocks[test_name] = HttpMock(pytestconfig.rootpath, test_name)
+        return http_mocks[test_name]
+
+    return make
+
+
+@pytest.fixture(scope="session")
+def sdist_metadata_mock_factory(
+    pytestconfig: pytest.Config,
+) -> Callable[[str], SdistMetadataMock]:
+    sdist_metadata_mocks: dict[str, SdistMetadataMock] = {}
+
+    def make(test_name: str) -> SdistMetadataMock:
+        if test_name not in sdist_metadata_mocks:
+            sdist_metadata_mocks[test_name] = SdistMetadataMock(
+                test_name, pytestconfig.rootpath
+            )
+        return sdist_metadata_mocks[test_name]
+
+    return make
+
+
+@pytest.fixture()
+def fake_cache(pytestconfig: pytest.Config, tmp_path: Path) -> Path:
+    """A private copy of the checked in cache, so parallel workers (pytest-xdist) and
+    reruns don't see each other's writes. Snapshot updates write to the original"""
+    source = pytestconfig.rootpath.joinpath("test-data", "fake_cache")
+    if update_snapshots:
+        return source
+    target = tmp_path.joinpath("fake_cache")
+    if source.is_dir():
+        shutil.copytree(source, target)
+    return target
+
+
 def assert_resolution(resolution: Resolution, rootpath: Path, name: str):
-    frozen = "\n".join(
-        sorted(f"{name}=={version}" for name, version in resolution.package_data)
-    )
-    requirements_txt = (
-        rootpath.joinpath("test-data").joinpath(name).joinpath("requirements.txt")
-    )
+    # Formatted once per package and sorted in place. Sorting the strings (not the
+    # names) is what the snapshots use
+    lines = [f"{name}=={version}" for name, version in resolution.package_data]
+    lines.sort()
+    frozen = "\n".join(lines)
+    requirements_txt = rootpath.joinpath("test-data", name, "requirements.txt")
     if update_snapshots:
         requirements_txt.write_text(frozen)
     assert frozen == requirements_txt.read_text()
@@ -226,12 +568,13 @@ def assert_resolution(resolution: Resolution, rootpath: Path, name: str):
 
 @pytest.mark.asyncio()
 @respx.mock(assert_all_mocked=assert_all_mocked, assert_all_called=assert_all_called)
-async def test_pandas(respx_mock: MockRouter, pytestconfig: pytest.Config):
+async def test_pandas(
+    respx_mock: MockRouter, pytestconfig: pytest.Config, http_mock_factory
+):
     """Simplest case, doesn't use any sdists"""
-    http_mock = HttpMock(pytestconfig.rootpath, "pandas")
+    http_mock = http_mock_factory("pandas")
     http_mock.add_mocks(respx_mock)
 
-    requires_python = VersionSpecifiers(">= 3.8")
     resolution = await resolve_requirement(
         Requirement("pandas"),
         requires_python,
@@ -244,17 +587,17 @@ async def test_pandas(respx_mock: MockRouter, pytestconfig: pytest.Config):
 @pytest.mark.asyncio()
 @respx.mock(assert_all_mocked=assert_all_mocked, assert_all_called=assert_all_called)
 async def test_meine_stadt_transparent(
-    respx_mock: MockRouter, pytestconfig: pytest.Config
+    respx_mock: MockRouter,
+    pytestconfig: pytest.Config,
+    http_mock_factory,
+    sdist_metadata_mock_factory,
 ):
-    http_mock = HttpMock(pytestconfig.rootpath, "meine_stadt_transparent")
+    http_mock = http_mock_factory("meine_stadt_transparent")
     http_mock.add_mocks(respx_mock)
-    sdist_metadata_mock = SdistMetadataMock(
-        "meine_stadt_transparent", pytestconfig.rootpath
-    )
+    sdist_metadata_mock = sdist_metadata_mock_factory("meine_stadt_transparent")
     with patch(
         "resolve_prototype.sdist.build_sdist", sdist_metadata_mock.mock_build_sdist
     ):
-        requires_python = VersionSpecifiers(">= 3.8")
         resolution = await resolve_requirement(
             Requirement("meine_stadt_transparent"),
             requires_python,
@@ -266,18 +609,20 @@ async def test_meine_stadt_transparent(
 
 @pytest.mark.asyncio()
 @respx.mock(assert_all_mocked=assert_all_mocked, assert_all_called=assert_all_called)
-async def test_matplotlib(respx_mock: MockRouter, pytestconfig: pytest.Config):
+async def test_matplotlib(
+    respx_mock: MockRouter,
+    pytestconfig: pytest.Config,
+    http_mock_factory,
+    fake_cache: Path,
+):
     """Test wheel metadata downloading"""
 
-    http_mock = HttpMock(pytestconfig.rootpath, "matplotlib")
+    http_mock = http_mock_factory("matplotlib")
     http_mock.add_mocks(respx_mock)
-    cache_dir = pytestconfig.rootpath.joinpath("test-data").joinpath("fake_cache")
-    requires_python = VersionSpecifiers(">= 3.8")
     resolution = await resolve_requirement(
         Requirement("matplotlib"),
         requires_python,
-        TrimmedMetadataCache(cache_dir, read=True, write=True),
+        TrimmedMetadataCache(fake_cache, read=True, write=True),
         download_wheels=True,
-        executor=DummyExecutor,
     )
     assert_resolution(resolution, pytestconfig.rootpath, "matplotlib")